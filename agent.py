@@ -11,7 +11,7 @@ It constructs prompts, processes LLM responses, and determines when to use tools
 import json # Keep for parsing LLM responses if needed
 import os
 import sys
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 from llm import LLMClient
 from repomapper import RepoMapper # Keep for agent's internal use if needed (e.g., environment details)
@@ -27,6 +27,13 @@ from utils import (
     eval_in_emacs
 )
 
+# System prompts already built in this worker, keyed by (session_path, model_name).
+# Everything else the prompt depends on (OS, shell, home, tool list) is fixed for the process.
+_system_prompt_cache: Dict[Tuple[str, str], str] = {}
+# RepoMapper per session_path, kept for the life of the worker so its tags
+# cache and parsed trees carry over from one request to the next.
+_repo_mappers: Dict[str, RepoMapper] = {}
+
 class Agent:
     """
     Manages the agentic interaction loop for a given session.
@@ -57,7 +64,9 @@ class Agent:
         self.environment_details_str = "" # Initialize, will be updated by worker loop
         self.verbose = verbose
         # Keep RepoMapper instance, but usage is restricted
-        self.repo_mapper = RepoMapper(root_dir=self.session_path, verbose=self.verbose)
+        self.repo_mapper = _repo_mappers.get(self.session_path)
+        if self.repo_mapper is None:
+            self.repo_mapper = _repo_mappers[self.session_path] = RepoMapper(root_dir=self.session_path, verbose=self.verbose)
         # History truncation settings
         self.max_history_tokens = 8000  # Target max tokens for history
         self.min_history_messages = 3   # Always keep at least this many messages
@@ -75,7 +84,13 @@ class Agent:
     # --- Prompt Building ---
 
     def _build_system_prompt(self) -> str:
-        """Builds the system prompt, inserting dynamic info and formatted tool list."""
+        """Builds the system prompt, inserting dynamic info and formatted tool list.
+        The result is cached per session and model so every request sends the same prefix."""
+        cache_key = (self.session_path, self.llm_client.model_name)
+        cached_prompt = _system_prompt_cache.get(cache_key)
+        if cached_prompt is not None:
+            return cached_prompt
+
         session_dir = self.session_path
         os_name = get_os_name()
         shell = "/bin/bash" # Default shell - TODO: Get from Emacs?
@@ -97,6 +112,7 @@ class Agent:
             homedir=homedir.replace(os.sep, '/'),
             tools_json=tools_json_string # Insert the formatted tool definitions
         )
+        _system_prompt_cache[cache_key] = prompt
         return prompt
 
     # --- LLM Prompt Preparation & History Management ---
@@ -114,16 +130,17 @@ class Agent:
         messages_to_send.extend(self._truncate_history(current_interaction_history))
 
         # --- Append Environment Details (Stored in self.environment_details_str) ---
-        # Use copy() to avoid modifying the history object directly
-        last_message_copy = messages_to_send[-1].copy()
-        last_message_copy["content"] += f"\n\n{self.environment_details_str}" # Append stored details
-        messages_to_send[-1] = last_message_copy # Replace the last message
+        # Sent as a trailing message of its own: the history messages then go out
+        # exactly as they are stored, so the prefix sent this turn is repeated
+        # unchanged next turn and provider-side prompt caches keep hitting it.
+        if self.environment_details_str:
+            messages_to_send.append({"role": "user", "content": self.environment_details_str})
 
         return messages_to_send
 
     def _call_llm_and_stream_response(self, messages_to_send: List[Dict]) -> Optional[str]:
         """Calls the LLM, streams the response, and returns the full response text."""
-        full_response = ""
+        response_parts = [] # Joined once the stream ends
         eval_in_emacs("emigo--flush-buffer", self.session_path, "\nAssistant:\n", "llm") # Signal start
         try:
             # Send the temporary list with context included
@@ -132,9 +149,9 @@ class Agent:
                 # Ensure chunk is a string, default to empty string if None
                 content_to_flush = chunk or ""
                 eval_in_emacs("emigo--flush-buffer", self.session_path, content_to_flush, "llm")
-                if chunk: # Only append non-None chunks to full_response
-                    full_response += chunk
-            return full_response
+                if chunk: # Only append non-None chunks to the response
+                    response_parts.append(chunk)
+            return "".join(response_parts)
         except Exception as e:
             error_message = f"[Error during LLM communication: {e}]"
             print(f"\n{error_message}", file=sys.stderr)
@@ -151,21 +168,28 @@ class Agent:
             return []
 
         # Always keep first user message for context
-        truncated = [history[0]]
-        current_tokens = self._count_tokens(truncated[0]["content"])
-
-        # Add messages from newest to oldest until we hit the limit
-        for msg in reversed(history[1:]):
+        first = history[0]
+        current_tokens = self._count_tokens(first["content"])
+
+        # Add messages from newest to oldest until we hit the limit; collected
+        # newest first and reversed once, instead of inserting at the front
+        kept = []
+        for index in range(len(history) - 1, 0, -1):
+            msg = history[index]
             msg_tokens = self._count_tokens(msg["content"])
             if current_tokens + msg_tokens > self.max_history_tokens:
-                if len(truncated) >= self.min_history_messages:
+                if len(kept) + 1 >= self.min_history_messages:
                     break
                 # If we're below min messages, keep going but warn
                 print("Warning: History exceeds token limit but below min message count", file=sys.stderr)
 
-            truncated.insert(1, msg)  # Insert after first message
+            kept.append(msg)
             current_tokens += msg_tokens
 
+        kept.append(first)
+        kept.reverse()
+        truncated = kept
+
         if self.verbose and len(truncated) < len(history):
             print(f"History truncated from {len(history)} to {len(truncated)} messages ({current_tokens} tokens)", file=sys.stderr)
 
@@ -23,6 +23,8 @@ TOOL_RESULT_OUTPUT_PREFIX = "Tool output:\n"
 TOOL_DENIED = "The user denied this operation."
 TOOL_ERROR_PREFIX = "[Tool Error] "
 TOOL_ERROR_SUFFIX = ""
+# Returned by attempt_completion to end the interaction loop
+TOOL_COMPLETION_SIGNALLED = "COMPLETION_SIGNALLED"
 
 
 # --- Ignored Directories ---
@@ -41,17 +41,40 @@
   :type 'hook
   :group 'emigo)
 
+(defun emigo--set-model-option (symbol value)
+  "Set SYMBOL to VALUE and tell the Python side to drop its cached model options."
+  (set-default symbol value)
+  (when (and (boundp 'emigo-epc-process)
+             (emigo-epc-live-p emigo-epc-process))
+    (emigo-call-async "invalidate_config_cache")))
+
 (defcustom emigo-model ""
-  "Default AI model.")
+  "Default AI model."
+  :initialize #'custom-initialize-default
+  :set #'emigo--set-model-option)
 
 (defcustom emigo-base-url ""
-  "Base URL for AI model.")
+  "Base URL for AI model."
+  :initialize #'custom-initialize-default
+  :set #'emigo--set-model-option)
 
 (defcustom emigo-api-key ""
-  "API key for AI model.")
+  "API key for AI model."
+  :initialize #'custom-initialize-default
+  :set #'emigo--set-model-option)
 
 (defcustom emigo-extra-headers ""
-  "Custom header for AI model API requests.")
+  "Custom header for AI model API requests."
+  :initialize #'custom-initialize-default
+  :set #'emigo--set-model-option)
+
+(defcustom emigo-response-cache nil
+  "Reuse the LLM response to an identical earlier request instead of calling the model.
+Responses are cached on disk under ~/.cache/emigo/responses and only reused
+when the model, the whole prompt and the tool list match exactly."
+  :type 'boolean
+  :initialize #'custom-initialize-default
+  :set #'emigo--set-model-option)
 
 (defcustom emigo-config-location (expand-file-name (locate-user-emacs-file "emigo/"))
   "Directory where emigo will store configuration files."
@@ -278,7 +301,11 @@ Then Emigo will start by gdb, please send new issue with `emigo-name' buffer con
         (setq emigo-internal-process-args emigo-args))
 
       ;; Start python process.
-      (let ((process-connection-type t))
+      (let ((process-connection-type t)
+            ;; emigo.py only prints its diagnostic messages when EMIGO_DEBUG is set.
+            (process-environment (if emigo-enable-log
+                                     (cons "EMIGO_DEBUG=1" process-environment)
+                                   process-environment)))
         (setq emigo-internal-process
               (apply 'start-process
                      emigo-name emigo-name
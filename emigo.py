@@ -36,14 +36,22 @@ import os
 import sys
 import threading
 import traceback
+import logging
+import logging.handlers
+import atexit
 import subprocess
 import json
 import queue
+import concurrent.futures
 import time
 import re
+import selectors
+import signal
+import socket
+from operator import itemgetter
 from typing import Dict, List, Optional, Tuple
 from config import (
-    TOOL_DENIED
+    TOOL_DENIED, TOOL_COMPLETION_SIGNALLED
 )
 from tool_definitions import (
     # Tool Names
@@ -53,7 +61,8 @@ from tool_definitions import (
 from epc.server import ThreadingEPCServer
 from utils import (
     init_epc_client, close_epc_client, eval_in_emacs, message_emacs,
-    get_emacs_vars, get_emacs_func_result, _filter_environment_details
+    get_emacs_vars, get_emacs_func_result, _filter_environment_details,
+    parse_json_content, dump_json_content, logger
 )
 from session import Session
 # Import tool dispatcher
@@ -63,20 +72,212 @@ from tool_definitions import get_tool
 # Import json for displaying parameters during approval
 from typing import Any # Add Any
 
+# Diagnostic output is only printed when EMIGO_DEBUG is set in the environment.
+# Errors and warnings are always printed.
+EMIGO_DEBUG = bool(os.environ.get("EMIGO_DEBUG"))
+
+# Logger for the request-serving paths, writes through the "emigo" logger's handlers
+_log = logging.getLogger("emigo.server")
+_log.setLevel(logging.DEBUG if EMIGO_DEBUG else logging.INFO)
+
+# Pass values as %-style arguments, _dbg("... %s", value), so nothing is formatted when debugging is off
+if EMIGO_DEBUG:
+    def _dbg(msg, *args):
+        _log.debug(msg, *args)
+else:
+    def _dbg(msg, *args):
+        pass
+
+def _start_log_listener() -> logging.handlers.QueueListener:
+    """Moves the emigo logger's handlers behind a queue drained by a background thread.
+
+    Logging calls on EPC and worker threads then only enqueue a record; the
+    formatting and the stderr write happen on the listener thread.
+    """
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop) # Flush pending records on exit
+    return listener
+
+# Where profile stats are written when Emacs starts us with "profile" (emigo-enable-profile)
+EMIGO_PROFILE_OUT = os.environ.get("EMIGO_PROFILE_OUT", os.path.expanduser("~/emigo.prof"))
+
+_profiler_stop = None # Set by _start_profiler, called once by _stop_profiler
+
+def _start_profiler():
+    """Starts profiling all threads, the requests are served on EPC and reader threads.
+
+    Uses yappi when installed. Otherwise cProfile: from Python 3.12 one profiler
+    sees every thread, before that each new thread gets its own profiler and the
+    results are merged when stopping.
+    """
+    global _profiler_stop
+    try:
+        import yappi
+    except ImportError:
+        yappi = None
+
+    if yappi:
+        yappi.set_clock_type("wall") # Most of the time is spent waiting on Emacs and the worker
+        yappi.start()
+
+        def stop():
+            yappi.stop()
+            yappi.get_func_stats().save(EMIGO_PROFILE_OUT, type="pstat")
+    else:
+        import cProfile
+        import pstats
+
+        profilers = [cProfile.Profile()]
+        profilers_lock = threading.Lock()
+        if sys.version_info < (3, 12):
+            def _profile_new_thread(*_):
+                profiler = cProfile.Profile()
+                with profilers_lock:
+                    profilers.append(profiler)
+                profiler.enable() # Replaces this hook for the rest of the thread
+            threading.setprofile(_profile_new_thread)
+        profilers[0].enable()
+
+        def stop():
+            threading.setprofile(None)
+            with profilers_lock:
+                stats = pstats.Stats(*profilers)
+            stats.dump_stats(EMIGO_PROFILE_OUT)
+
+    _profiler_stop = stop
+    print(f"Profiling enabled, stats will be written to {EMIGO_PROFILE_OUT}", file=sys.stderr, flush=True)
+
+def _stop_profiler():
+    """Stops the profiler started by _start_profiler and writes its stats, if it is running."""
+    global _profiler_stop
+    stop, _profiler_stop = _profiler_stop, None
+    if stop is None:
+        return
+    try:
+        stop()
+        print(f"Profile stats written to {EMIGO_PROFILE_OUT}", file=sys.stderr, flush=True)
+    except Exception as e:
+        print(f"Error writing profile stats: {e}", file=sys.stderr, flush=True)
+
+def _exc_detail() -> str:
+    """Returns the traceback of the exception being handled, only when EMIGO_DEBUG is set."""
+    return "\n" + traceback.format_exc() if EMIGO_DEBUG else ""
+
+# On POSIX a single selector loop reads the worker's stdout/stderr and dispatches
+# messages inline, except WORKER_REQUEST_TYPES. Windows can't select on pipes, so it falls back to one reader
+# thread per stream plus a queue processor thread.
+USE_SELECT_READER = os.name != 'nt'
+# Worker messages that wait on a reply from us, answered in order on a single
+# worker-request thread since they can block on the user or on Emacs
+WORKER_REQUEST_TYPES = frozenset({"tool_request", "history_resync", "get_environment_details_request"})
+
+# Seconds to wait for the worker's status/ready message before carrying on without it
+WORKER_READY_TIMEOUT = 5.0
+# Bounds (seconds) of the exponential backoff between automatic worker restarts
+WORKER_RESTART_MIN_DELAY = 0.5
+WORKER_RESTART_MAX_DELAY = 30.0
+
+# Matches @file mentions in user prompts. The last character can't be sentence
+# punctuation, so "see @foo.py, then" yields "foo.py" without a separate rstrip.
+MENTION_RE = re.compile(r'@(\S*[^\s.,;:!?])')
+# Fenced code blocks (an unclosed fence runs to the end); "@" in pasted code,
+# e.g. decorators, is not a file mention
+CODE_FENCE_RE = re.compile(r'```.*?(?:```|\Z)', re.DOTALL)
+
+# Picks role and content out of a (:role r :content c) plist sent by Emacs
+_PLIST_ROLE_CONTENT = itemgetter(1, 3)
+
+# Emacs variables holding the model configuration, and how long (seconds) their
+# values are reused before being fetched from Emacs again
+EMACS_CONFIG_VARS = ["emigo-model", "emigo-base-url", "emigo-api-key", "emigo-extra-headers", "emigo-response-cache"]
+EMACS_CONFIG_TTL = 2.0
+
+# Tools that require explicit approval from Emacs before they are executed
+REQUIRE_APPROVAL_TOOLS = frozenset({
+    TOOL_EXECUTE_COMMAND,
+    TOOL_WRITE_TO_FILE,
+    # Add other tools needing approval if necessary
+})
+
+class _NoDelayEPCServer(ThreadingEPCServer):
+    """ThreadingEPCServer with Nagle's algorithm disabled on accepted connections.
+
+    EPC replies to Emacs are small writes; without TCP_NODELAY they can wait
+    on the delayed ACK of the previous one.
+    """
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        try:
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass # Not fatal, the connection just keeps Nagle's algorithm
+        return request, client_address
+
+def _coalesce_llm_stream(messages: List[Dict]) -> List[Dict]:
+    """Merges runs of consecutive "llm" stream messages for the same session.
+
+    Used on the messages parsed from one read of the worker's stdout, so text
+    the worker wrote faster than we dispatch reaches Emacs in one
+    emigo--flush-buffer call. Order relative to other messages is kept.
+    """
+    merged = []
+    for message in messages:
+        previous = merged[-1] if merged else None
+        if (previous is not None and message.get("type") == "stream" and message.get("role") == "llm"
+                and previous.get("type") == "stream" and previous.get("role") == "llm"
+                and previous.get("session") == message.get("session")):
+            merged[-1] = dict(previous, content=(previous.get("content") or "") + (message.get("content") or ""))
+        else:
+            merged.append(message)
+    return merged
+
+def _write_all(stream, data: bytes):
+    """Writes all of data to an unbuffered binary stream, retrying on partial writes.
+
+    Raises ValueError once the stream has been closed, instead of writing to
+    whatever the fd number has been reused for since.
+    """
+    view = memoryview(data)
+    while view:
+        written = stream.write(view)
+        view = view[written:]
+
+# Set by Emigo.cleanup to let the main thread exit
+_shutdown_event = threading.Event()
+
+# Methods of Emigo exposed to Emacs over EPC (keep in sync with the calls in emigo.el)
+EPC_METHODS = (
+    "emigo_send",
+    "emigo_send_revised_history",
+    "cancel_llm_interaction",
+    "add_file_to_context",
+    "remove_file_from_context",
+    "get_chat_files",
+    "get_history",
+    "clear_history",
+    "cleanup",
+    "invalidate_config_cache",
+)
+
 class Emigo:
     def __init__(self, args):
-        print("Emigo __init__: Starting initialization...", file=sys.stderr, flush=True) # DEBUG + flush
+        self._log_listener = _start_log_listener()
+        _dbg("Emigo __init__: Starting initialization...")
         # Init EPC client port.
-        print(f"Emigo __init__: Received args: {args}", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Received args: %s", args)
         if not args:
             print("Emigo __init__: ERROR - No parameters received (expected EPC port). Exiting.", file=sys.stderr, flush=True)
             sys.exit(1)
         try:
             elisp_epc_port = int(args[0])
-            print(f"Emigo __init__: Attempting to connect to Elisp EPC server on port {elisp_epc_port}...", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg("Emigo __init__: Attempting to connect to Elisp EPC server on port %s...", elisp_epc_port)
             # Initialize the EPC client connection to Emacs (utils.py) *before* using it
             init_epc_client(elisp_epc_port)
-            print(f"Emigo __init__: EPC client initialized for Elisp port {elisp_epc_port}", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg("Emigo __init__: EPC client initialized for Elisp port %s", elisp_epc_port)
         except (IndexError, ValueError) as e:
             print(f"Emigo __init__: ERROR - Invalid or missing Elisp EPC port argument: {args}. Error: {e}", file=sys.stderr, flush=True) # DEBUG + flush
             sys.exit(1)
@@ -85,26 +286,50 @@ class Emigo:
             sys.exit(1) # Exit if we can't connect back to Emacs
 
         # Init vars.
-        print("Emigo __init__: Initializing internal variables...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Initializing internal variables...")
         # Replace individual state dicts with a single sessions dictionary
         self.sessions: Dict[str, Session] = {} # Key: session_path, Value: Session object
+        self._sessions_lock = threading.Lock() # Serializes Session creation
 
         # --- Worker Process Management ---
         self.llm_worker_process: Optional[subprocess.Popen] = None
         self.llm_worker_reader_thread: Optional[threading.Thread] = None
         self.llm_worker_stderr_thread: Optional[threading.Thread] = None
+        self._worker_stdin = None # Unbuffered binary file object of the worker's stdin pipe
+        self._worker_ready = threading.Event() # Set once the worker reports it is ready
+        self._worker_ready_seen = False
+        # Backoff state for automatic restarts from _send_to_worker
+        self._worker_restart_lock = threading.Lock()
+        self._worker_restart_state = {'last': 0.0, 'delay': WORKER_RESTART_MIN_DELAY}
         self.llm_worker_lock = threading.Lock()
-        self.worker_output_queue = queue.Queue() # Messages from worker stdout
-        self.pending_tool_requests: Dict[str, Dict] = {} # {request_id (tool_call_id): original_tool_request_data}
+        # Messages waiting to be written to the worker, and whether a thread is writing them
+        self._send_buffer: List[Dict] = []
+        self._send_buffer_lock = threading.Lock()
+        self._send_flushing = False
+        # session_path -> (history_version, length) of the session history the worker holds a copy of
+        self._worker_history: Dict[str, Tuple[int, int]] = {}
+        self.worker_output_queue = queue.Queue() # Messages from worker stdout (Windows reader threads only)
+        self._worker_request_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="WorkerRequest") # Answers WORKER_REQUEST_TYPES
+        # (monotonic timestamp, values of EMACS_CONFIG_VARS) of the last fetch from Emacs
+        self._config_cache: Optional[Tuple[float, List]] = None
         self.active_interaction_session: Optional[str] = None # Track which session is currently interacting
+        self._session_slot_lock = threading.Lock() # Guards claims/releases of active_interaction_session
+        self._interaction_busy = False # Mirrors active_interaction_session is not None, checked without the lock
+        self._cleanup_lock = threading.Lock() # cleanup() can come from Emacs, atexit or a signal
+        self._cleaned_up = False
 
         # --- EPC Server Setup ---
-        print("Emigo __init__: Setting up Python EPC server...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Setting up Python EPC server...")
         try:
-            self.server = ThreadingEPCServer(('127.0.0.1', 0), log_traceback=True)
+            self.server = _NoDelayEPCServer(('127.0.0.1', 0), log_traceback=True)
             # self.server.logger.setLevel(logging.DEBUG)
             self.server.allow_reuse_address = True
-            print(f"Emigo __init__: Python EPC server created. Will listen on port {self.server.server_address[1]}", file=sys.stderr, flush=True) # DEBUG + flush
+            # Handler threads (one per Emacs connection) must not keep the process
+            # alive or make server_close() wait for them
+            self.server.daemon_threads = True
+            self.server.block_on_close = False
+            _dbg("Emigo __init__: Python EPC server created. Will listen on port %s", self.server.server_address[1])
         except Exception as e:
             print(f"Emigo __init__: ERROR creating Python EPC server: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
             sys.exit(1)
@@ -116,28 +341,32 @@ class Emigo:
         # self.server.logger.addHandler(ch)
         # self.server.logger = logger # Keep logging setup if needed
 
-        print("Emigo __init__: Registering instance methods with Python EPC server...", file=sys.stderr, flush=True) # DEBUG + flush
-        self.server.register_instance(self)  # register instance functions let elisp side call
-        print("Emigo __init__: Instance registered with Python EPC server.", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Registering instance methods with Python EPC server...")
+        # Register only the methods elisp side calls, instead of the whole instance
+        for method_name in EPC_METHODS:
+            self.server.register_function(getattr(self, method_name), method_name)
+        _dbg("Emigo __init__: Instance methods registered with Python EPC server.")
 
         # Start Python EPC server with sub-thread.
         try:
-            print("Emigo __init__: Starting Python EPC server thread...", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg("Emigo __init__: Starting Python EPC server thread...")
             self.server_thread = threading.Thread(target=self.server.serve_forever, name="PythonEPCServerThread")
             self.server_thread.daemon = True # Allow main thread to exit even if this hangs
+            # The port is already bound by the ThreadingEPCServer constructor, no need to wait
             self.server_thread.start()
-            # Give the server a moment to bind the port
-            time.sleep(0.1)
             if not self.server_thread.is_alive():
                 print("Emigo __init__: ERROR - Python EPC server thread failed to start.", file=sys.stderr, flush=True)
                 sys.exit(1)
-                print(f"Emigo __init__: Python EPC server thread started. Listening on port {self.server.server_address[1]}", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg("Emigo __init__: Python EPC server thread started. Listening on port %s", self.server.server_address[1])
         except Exception as e:
             print(f"Emigo __init__: ERROR starting Python EPC server thread: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
             sys.exit(1) # Exit if server thread fails
 
+        # Stop the worker and the server on any normal interpreter exit, not only when Emacs calls cleanup
+        atexit.register(self.cleanup)
+
         # Start the worker process
-        print("Emigo __init__: Starting LLM worker process...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Starting LLM worker process...")
         self._start_llm_worker()
         # Check if worker started successfully
         worker_ok = False
@@ -156,37 +385,40 @@ class Emigo:
                     print(f"Emigo __init__: Error reading worker stderr after exit: {read_err}", file=sys.stderr, flush=True)
                     sys.exit(1) # Exit if worker failed
 
-        print("Emigo __init__: LLM worker process started successfully.", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: LLM worker process started successfully.")
 
 
-        self.worker_processor_thread = threading.Thread(target=self._process_worker_queue, name="WorkerQueueProcessorThread", daemon=True)
-        self.worker_processor_thread.start()
-        if not self.worker_processor_thread.is_alive():
-            print("Emigo __init__: ERROR - Worker queue processor thread failed to start.", file=sys.stderr, flush=True)
-            sys.exit(1)
-            print("Emigo __init__: Worker queue processor thread started.", file=sys.stderr, flush=True) # DEBUG + flush
+        self.worker_processor_thread: Optional[threading.Thread] = None
+        if not USE_SELECT_READER:
+            self.worker_processor_thread = threading.Thread(target=self._process_worker_queue, name="WorkerQueueProcessorThread", daemon=True)
+            self.worker_processor_thread.start()
+            if not self.worker_processor_thread.is_alive():
+                print("Emigo __init__: ERROR - Worker queue processor thread failed to start.", file=sys.stderr, flush=True)
+                sys.exit(1)
+            _dbg("Emigo __init__: Worker queue processor thread started.")
 
         # Pass Python epc port back to Emacs when first start emigo.
         try:
             python_epc_port = self.server.server_address[1]
-            print(f"Emigo __init__: Sending emigo--first-start signal to Elisp for Python EPC port {python_epc_port}...", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg("Emigo __init__: Sending emigo--first-start signal to Elisp for Python EPC port %s...", python_epc_port)
             eval_in_emacs('emigo--first-start', python_epc_port)
-            print(f"Emigo __init__: Sent emigo--first-start signal for port {python_epc_port}", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg("Emigo __init__: Sent emigo--first-start signal for port %s", python_epc_port)
         except Exception as e:
             # This might happen if Emacs EPC server isn't ready yet or the connection failed earlier.
             print(f"Emigo __init__: ERROR sending emigo--first-start signal to Elisp: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
             # Don't exit here, maybe the connection will recover, but log clearly.
 
         # Initialization complete. The main thread will likely wait for EPC events or signals.
-        print("Emigo __init__: Initialization sequence complete. Emigo should be running.", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Initialization sequence complete. Emigo should be running.")
 
     # --- Worker Process Management ---
 
     def _start_llm_worker(self):
         """Starts the llm_worker.py subprocess."""
+        started = None # (process, ready event) once the process and its readers are up
         with self.llm_worker_lock:
             if self.llm_worker_process and self.llm_worker_process.poll() is None:
-                print("LLM worker process already running.", file=sys.stderr)
+                _dbg("LLM worker process already running.")
                 return # Already running
 
             worker_script = os.path.join(os.path.dirname(__file__), "llm_worker.py")
@@ -194,7 +426,7 @@ class Emigo:
             worker_script_path = os.path.abspath(worker_script)
 
             try:
-                print(f"_start_llm_worker: Starting LLM worker process: {python_executable} {worker_script_path}", file=sys.stderr, flush=True) # DEBUG + flush
+                _dbg("_start_llm_worker: Starting LLM worker process: %s %s", python_executable, worker_script_path)
                 self.llm_worker_process = subprocess.Popen(
                     [python_executable, worker_script_path],
                     stdin=subprocess.PIPE,
@@ -208,28 +440,23 @@ class Emigo:
                     # Use process_group=True on Unix-like systems if needed for cleaner termination
                     # process_group=True if os.name != 'nt' else False
                 )
-                # Brief pause to see if process exits immediately
-                time.sleep(0.5) # Increased sleep time
-                if self.llm_worker_process.poll() is not None:
-                    print(f"_start_llm_worker: ERROR - LLM worker process exited immediately with code {self.llm_worker_process.poll()}.", file=sys.stderr, flush=True)
-                    # Try reading stderr quickly
-                    try:
-                        stderr_output = self.llm_worker_process.stderr.read() if self.llm_worker_process.stderr else "N/A"
-                        print(f"_start_llm_worker: Worker stderr upon exit:\n{stderr_output}", file=sys.stderr, flush=True)
-                    except Exception as read_err:
-                        print(f"_start_llm_worker: Error reading worker stderr after exit: {read_err}", file=sys.stderr, flush=True)
-
-                    # Regardless of stderr read success, set process to None and notify Emacs
-                    exit_code = self.llm_worker_process.poll() # Get exit code again just in case
-                    self.llm_worker_process = None
-                    message_emacs(f"Error: LLM worker process failed to start (exit code {exit_code}). Check *Messages* or Emigo process buffer.")
-                    return # Exit the function
-
-                print(f"_start_llm_worker: LLM worker started (PID: {self.llm_worker_process.pid}).", file=sys.stderr, flush=True)
-
-                # Create and start the stdout reader thread *after* process starts
-                print("_start_llm_worker: Starting stdout reader thread...", file=sys.stderr, flush=True) # DEBUG + flush
-                self.llm_worker_reader_thread = threading.Thread(target=self._read_worker_stdout, name="WorkerStdoutReader", daemon=True)
+                _dbg("_start_llm_worker: LLM worker started (PID: %s).", self.llm_worker_process.pid)
+                self._worker_history = {} # A new worker holds no history yet
+                stdin = self.llm_worker_process.stdin
+                self._worker_stdin = getattr(stdin, "buffer", stdin) # The raw FileIO under the text wrapper
+                # Set by the reader thread once the worker announces it is ready (or exits)
+                self._worker_ready = threading.Event()
+                self._worker_ready_seen = False
+
+                # Create and start the reader thread *after* process starts.
+                # On POSIX a single thread multiplexes stdout and stderr with select;
+                # Windows can't select on pipes, so it keeps a dedicated stderr thread.
+                if USE_SELECT_READER:
+                    reader_target, reader_name = self._read_worker_output, "WorkerOutputReader"
+                else:
+                    reader_target, reader_name = self._read_worker_stdout, "WorkerStdoutReader"
+                _dbg("_start_llm_worker: Starting %s thread...", reader_name)
+                self.llm_worker_reader_thread = threading.Thread(target=reader_target, name=reader_name, daemon=True)
                 self.llm_worker_reader_thread.start()
                 if not self.llm_worker_reader_thread.is_alive():
                     print("_start_llm_worker: ERROR - stdout reader thread failed to start.", file=sys.stderr, flush=True)
@@ -239,25 +466,52 @@ class Emigo:
                         self.llm_worker_process = None
                     return
 
-                print("_start_llm_worker: Starting stderr reader thread...", file=sys.stderr, flush=True) # DEBUG + flush
-                self.llm_worker_stderr_thread = threading.Thread(target=self._read_worker_stderr, name="WorkerStderrReader", daemon=True)
-                self.llm_worker_stderr_thread.start()
-                if not self.llm_worker_stderr_thread.is_alive():
-                    print("_start_llm_worker: ERROR - stderr reader thread failed to start.", file=sys.stderr, flush=True)
-                    # Attempt cleanup
-                    if self.llm_worker_process and self.llm_worker_process.poll() is None:
-                        self.llm_worker_process.terminate()
-                        self.llm_worker_process = None
-                    return
-
-                print("_start_llm_worker: Worker process and reader threads seem to be started.", file=sys.stderr, flush=True) # DEBUG + flush
+                if not USE_SELECT_READER:
+                    _dbg("_start_llm_worker: Starting stderr reader thread...")
+                    self.llm_worker_stderr_thread = threading.Thread(target=self._read_worker_stderr, name="WorkerStderrReader", daemon=True)
+                    self.llm_worker_stderr_thread.start()
+                    if not self.llm_worker_stderr_thread.is_alive():
+                        print("_start_llm_worker: ERROR - stderr reader thread failed to start.", file=sys.stderr, flush=True)
+                        # Attempt cleanup
+                        if self.llm_worker_process and self.llm_worker_process.poll() is None:
+                            self.llm_worker_process.terminate()
+                            self.llm_worker_process = None
+                        return
+
+                started = (self.llm_worker_process, self._worker_ready)
+                _dbg("_start_llm_worker: Worker process and reader threads seem to be started.")
 
             except Exception as e:
-                print(f"_start_llm_worker: Failed to start LLM worker: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
+                print(f"_start_llm_worker: Failed to start LLM worker: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True)
                 self.llm_worker_process = None
                 # Optionally notify Emacs of the failure
                 message_emacs(f"Error: Failed to start LLM worker subprocess: {e}")
 
+        if started is None:
+            return
+        proc, ready_event = started
+        # Wait for the worker's ready message instead of sleeping a fixed time. This happens
+        # outside llm_worker_lock, requests sent meanwhile just wait in the stdin pipe.
+        if not ready_event.wait(timeout=WORKER_READY_TIMEOUT):
+            # Slow but alive (e.g. a cold start), keep it; the reader marks it ready when the line arrives
+            _log.warning(f"_start_llm_worker: LLM worker not ready after {WORKER_READY_TIMEOUT}s, continuing without waiting.")
+            return
+        if self._worker_ready_seen or proc is not self.llm_worker_process:
+            return
+        # Output reached EOF before the ready message, the worker is exiting
+        try:
+            exit_code = proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            exit_code = None
+            proc.terminate()
+        # Its stderr has already been echoed by the reader thread
+        print(f"_start_llm_worker: ERROR - LLM worker process exited during startup (exit code {exit_code}).", file=sys.stderr, flush=True)
+        with self.llm_worker_lock:
+            if self.llm_worker_process is proc:
+                self.llm_worker_process = None
+                self._worker_stdin = None
+        message_emacs(f"Error: LLM worker process failed to start (exit code {exit_code}). Check *Messages* or Emigo process buffer.")
+
     def _get_environment_details_string(self, session_path: str) -> str:
         """Delegates fetching environment details to the Session object."""
         session = self._get_or_create_session(session_path)
@@ -271,7 +525,8 @@ class Emigo:
         """Stops the LLM worker subprocess and reader threads."""
         with self.llm_worker_lock:
             if self.llm_worker_process:
-                print("Stopping LLM worker process...", file=sys.stderr)
+                _dbg("Stopping LLM worker process...")
+                self._worker_stdin = None
                 if self.llm_worker_process.poll() is None: # Check if still running
                     try:
                         # Try closing stdin first to signal worker
@@ -287,30 +542,110 @@ class Emigo:
                         self.llm_worker_process.kill() # Force kill
                     except Exception as e:
                         print(f"Error stopping LLM worker: {e}", file=sys.stderr)
-                        self.llm_worker_process = None # Ensure process is marked as None
-                        print("LLM worker process stopped.", file=sys.stderr)
-
-            # Signal and wait for the queue processor thread to finish
-            if hasattr(self, 'worker_processor_thread') and self.worker_processor_thread and self.worker_processor_thread.is_alive():
-                print("Signaling worker queue processor thread to stop...", file=sys.stderr)
-                self.worker_output_queue.put(None) # Signal loop to exit
-                self.worker_processor_thread.join(timeout=2) # Wait for it
-                if self.worker_processor_thread.is_alive():
-                    print("Warning: Worker queue processor thread did not exit cleanly.", file=sys.stderr)
-                    self.worker_processor_thread = None # Mark as stopped
+                # Mark the process as gone so late output from it is discarded
+                self.llm_worker_process = None
+                _dbg("LLM worker process stopped.")
+
+    def _parse_worker_line(self, line) -> Optional[Dict]:
+        """Parses one stdout line from the worker into a message dict (None if invalid)."""
+        try:
+            message = parse_json_content(line)
+        except ValueError: # orjson.JSONDecodeError subclasses ValueError
+            print(f"Received invalid JSON from worker: {line!r}", file=sys.stderr)
+            return None
+        if not isinstance(message, dict):
+            print(f"Received non-object message from worker: {message!r}", file=sys.stderr)
+            return None
+        return message
+
+    def _read_worker_output(self):
+        """Runs the worker event loop: reads stdout and stderr with a selector.
+
+        Stdout messages are parsed and dispatched inline on this thread, stderr
+        lines are printed with a prefix. Returns when both streams reach EOF.
+        """
+        proc = self.llm_worker_process # Local reference
+        ready_event = self._worker_ready
+        if not (proc and proc.stdout and proc.stderr):
+            print("Worker process or output streams not available for reading.", file=sys.stderr)
+            ready_event.set()
+            return
+
+        out_fd = proc.stdout.fileno()
+        err_fd = proc.stderr.fileno()
+        pending = {out_fd: b"", err_fd: b""} # Partial lines per fd
+        selector = selectors.DefaultSelector()
+        selector.register(out_fd, selectors.EVENT_READ)
+        selector.register(err_fd, selectors.EVENT_READ)
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+                    fd = key.fd
+                    chunk = os.read(fd, 65536)
+                    if chunk:
+                        *lines, pending[fd] = (pending[fd] + chunk).split(b"\n")
+                    else:
+                        # EOF: handle any trailing partial line and stop watching this fd
+                        lines, pending[fd] = [pending[fd]], b""
+                        selector.unregister(fd)
+                        stream_name = "stdout" if fd == out_fd else "stderr"
+                        _dbg("LLM worker %s stream ended (EOF).", stream_name)
+
+                    messages = []
+                    for raw_line in lines:
+                        raw_line = raw_line.strip()
+                        if not raw_line:
+                            continue
+                        if fd == err_fd:
+                            line = raw_line.decode("utf-8", errors="replace")
+                            _log.info(f"[WORKER_STDERR] {line}")
+                            continue
+                        message = self._parse_worker_line(raw_line)
+                        if message is None:
+                            continue
+                        if message.get("type") == "status" and message.get("status") == "ready":
+                            self._worker_ready_seen = True
+                            ready_event.set()
+                        else:
+                            messages.append(message)
+                    # Otherwise it is late output from a stopped worker, discard it
+                    if messages and proc is self.llm_worker_process:
+                        for message in _coalesce_llm_stream(messages):
+                            self._dispatch_worker_message(message)
+        except (OSError, ValueError) as e:
+            # Raised when the pipes are closed underneath us
+            print(f"Error reading from LLM worker output (stream likely closed): {e}", file=sys.stderr)
+        except Exception as e:
+            print(f"Error reading from LLM worker output: {e}", file=sys.stderr)
+        finally:
+            selector.close()
+            # Wake _start_llm_worker if the worker died before becoming ready
+            ready_event.set()
+            _dbg("Worker event loop stopped.")
 
     def _read_worker_stdout(self):
-        """Reads stdout lines from the worker and puts them in a queue."""
+        """Reads stdout lines from the worker and puts the parsed messages in a queue."""
         # Use a loop that checks if the process is alive
         proc = self.llm_worker_process # Local reference
+        ready_event = self._worker_ready
+        # Keep putting into the queue this worker started with, even once it has been swapped out
+        output_queue = self.worker_output_queue
+        ready_seen = False
         if proc and proc.stdout:
             try:
                 for line in iter(proc.stdout.readline, ''):
                     if line:
-                        self.worker_output_queue.put(line.strip())
+                        message = self._parse_worker_line(line.strip()) if line.strip() else None
+                        if message is None:
+                            continue
+                        if message.get("type") == "status" and message.get("status") == "ready":
+                            ready_seen = self._worker_ready_seen = True
+                            ready_event.set()
+                        else:
+                            output_queue.put(message)
                     else:
                         # Empty string indicates EOF (stream closed)
-                        print("LLM worker stdout stream ended (EOF).", file=sys.stderr)
+                        _dbg("LLM worker stdout stream ended (EOF).")
                         break
             except ValueError as e:
                 # Catch ValueError: I/O operation on closed file.
@@ -319,13 +654,16 @@ class Emigo:
                 # Handle other exceptions during read
                 print(f"Error reading from LLM worker stdout: {e}", file=sys.stderr)
             finally:
-                # Ensure the sentinel is put even if errors occur or loop finishes
-                print("Signaling end of worker output.", file=sys.stderr)
-                self.worker_output_queue.put(None)
+                # Wake _start_llm_worker if the worker died before becoming ready
+                ready_event.set()
+                # Ensure the sentinel is put even if errors occur or loop finishes,
+                # unless the worker never became ready and was never handed over
+                if ready_seen:
+                    _dbg("Signaling end of worker output.")
+                    output_queue.put(None)
         else:
             print("Worker process or stdout not available for reading.", file=sys.stderr)
-            # Still signal end if the thread was started but process died quickly
-            self.worker_output_queue.put(None)
+            ready_event.set()
 
     def _read_worker_stderr(self):
         """Reads and prints stderr lines from the worker."""
@@ -336,10 +674,10 @@ class Emigo:
                 for line in iter(proc.stderr.readline, ''):
                     if line:
                         # Print worker errors clearly marked
-                        print(f"[WORKER_STDERR] {line.strip()}", file=sys.stderr, flush=True)
+                        _log.info(f"[WORKER_STDERR] {line.strip()}")
                     else:
                         # Empty string indicates EOF
-                        print("LLM worker stderr stream ended (EOF).", file=sys.stderr)
+                        _dbg("LLM worker stderr stream ended (EOF).")
                         break
             except ValueError as e:
                 # Catch ValueError: I/O operation on closed file.
@@ -349,185 +687,270 @@ class Emigo:
         else:
             print("Worker process or stderr not available for reading.", file=sys.stderr)
 
+    def _restart_llm_worker_with_backoff(self) -> bool:
+        """Restarts a dead worker, backing off exponentially after failed attempts.
+
+        Keeps a crash-looping worker (e.g. bad config) from being respawned on every send.
+        Returns True if a worker is running afterwards.
+        """
+        if not self._worker_restart_lock.acquire(blocking=False):
+            print("Worker restart already in progress, not starting another one.", file=sys.stderr)
+            return False
+        try:
+            state = self._worker_restart_state
+            now = time.monotonic()
+            if now - state['last'] < state['delay']:
+                print(f"Skipping worker restart, backing off for {state['delay']:.1f}s after a failed start.", file=sys.stderr)
+                return False
+            state['last'] = now
+            self._start_llm_worker()
+            if self.llm_worker_process:
+                state['delay'] = WORKER_RESTART_MIN_DELAY
+                return True
+            state['delay'] = min(state['delay'] * 2, WORKER_RESTART_MAX_DELAY)
+            return False
+        finally:
+            self._worker_restart_lock.release()
+
+    def _ensure_worker_running(self, session: str) -> bool:
+        """Restarts the worker if it has died; returns False (after telling Emacs) if none is running."""
+        if self.llm_worker_process and self.llm_worker_process.poll() is None:
+            return True
+        _log.error("Cannot send to worker, process not running. Attempting restart...")
+        if self._restart_llm_worker_with_backoff():
+            return True
+        _log.error("Worker restart failed. Cannot send message.")
+        # Notify Emacs about the failure
+        eval_in_emacs("emigo--flush-buffer", session, "[Error: LLM worker process is not running]", "error")
+        return False
+
     def _send_to_worker(self, data: Dict):
         """Sends a JSON message to the worker's stdin."""
-        with self.llm_worker_lock:
-            if not self.llm_worker_process or self.llm_worker_process.poll() is not None:
-                print("Cannot send to worker, process not running. Attempting restart...", file=sys.stderr)
-                self._start_llm_worker() # Try restarting
-                if not self.llm_worker_process:
-                    print("Worker restart failed. Cannot send message.", file=sys.stderr)
-                    # Notify Emacs about the failure
-                    session = data.get("session", "unknown")
-                    eval_in_emacs("emigo--flush-buffer", session, "[Error: LLM worker process is not running]", "error")
-                    return
+        session = data.get("session", "unknown")
+        if not self._ensure_worker_running(session):
+            return
+
+        # The file object of the worker this send started with; if _stop_llm_worker closes it
+        # meanwhile, writing raises instead of reaching a reused fd (or the next worker)
+        proc, stdin = self.llm_worker_process, self._worker_stdin
+        if stdin is None: # Process exists but stdin is closed
+            _log.error("Cannot send to worker, stdin not available or closed.")
+            eval_in_emacs("emigo--flush-buffer", session, "[Error: Cannot write to LLM worker process]", "error")
+            return
+
+        # Group commit: the first caller becomes the writer and also sends whatever
+        # other threads buffer in the meantime, coalesced into one batch message.
+        with self._send_buffer_lock:
+            self._send_buffer.append(data)
+            if self._send_flushing:
+                return # The active writer will pick it up
+            self._send_flushing = True
 
-            if self.llm_worker_process and self.llm_worker_process.stdin:
+        try:
+            while True:
+                with self._send_buffer_lock:
+                    items, self._send_buffer = self._send_buffer, []
+                    if not items:
+                        self._send_flushing = False
+                        return
+                payload = items[0] if len(items) == 1 else {"type": "batch", "items": items}
                 try:
-                    json_str = json.dumps(data) + '\n' # Add newline separator
-                    # print(f"Sending to worker: {json_str.strip()}", file=sys.stderr) # Debug
-                    self.llm_worker_process.stdin.write(json_str)
-                    self.llm_worker_process.stdin.flush()
-                except (OSError, BrokenPipeError, ValueError) as e: # Added ValueError for closed file
-                    print(f"Error sending to LLM worker (Pipe closed or invalid state): {e}", file=sys.stderr)
-                    # Worker has likely crashed or exited. Stop tracking it.
-                    self._stop_llm_worker() # Attempt cleanup, might set self.llm_worker_process to None
-                    # Notify Emacs about the failure
-                    session = data.get("session", "unknown")
-                    eval_in_emacs("emigo--flush-buffer", session, f"[Error: Failed to send message to worker ({e})]", "error")
-                except Exception as e:
-                    print(f"Unexpected error sending to LLM worker: {e}", file=sys.stderr)
-                    # Also notify Emacs
-                    session = data.get("session", "unknown")
-                    eval_in_emacs("emigo--flush-buffer", session, f"[Error: Unexpected error sending message to worker ({e})]", "error")
-            elif not self.llm_worker_process: # Check if process is None
-                 print("Cannot send to worker, process is not running.", file=sys.stderr)
-                 # Notify Emacs
-                 session = data.get("session", "unknown")
-                 eval_in_emacs("emigo--flush-buffer", session, "[Error: LLM worker process is not running]", "error")
-            else: # Process exists but stdin might be closed
-                 print("Cannot send to worker, stdin not available or closed.", file=sys.stderr)
-                 # Notify Emacs
-                 session = data.get("session", "unknown")
-                 eval_in_emacs("emigo--flush-buffer", session, "[Error: Cannot write to LLM worker process]", "error")
+                    encoded = dump_json_content(payload)
+                except TypeError: # orjson is stricter about types, let json try its conversions
+                    encoded = json.dumps(payload).encode('utf-8')
+                framed = encoded + b'\n' # Newline-delimited message
+                # The stream is unbuffered, writing needs no flush
+                _write_all(stdin, framed)
+        except (OSError, BrokenPipeError, ValueError) as e: # Added ValueError for closed file
+            self._discard_send_buffer()
+            _log.error(f"Error sending to LLM worker (Pipe closed or invalid state): {e}")
+            # Worker has likely crashed or exited. Stop tracking it, unless it was already replaced
+            if proc is self.llm_worker_process:
+                self._stop_llm_worker() # Attempt cleanup, might set self.llm_worker_process to None
+            # Notify Emacs about the failure
+            eval_in_emacs("emigo--flush-buffer", session, f"[Error: Failed to send message to worker ({e})]", "error")
+        except Exception as e:
+            self._discard_send_buffer()
+            _log.error(f"Unexpected error sending to LLM worker: {e}")
+            # Also notify Emacs
+            eval_in_emacs("emigo--flush-buffer", session, f"[Error: Unexpected error sending message to worker ({e})]", "error")
 
+    def _discard_send_buffer(self):
+        """Drops messages buffered for a failed write and gives up the writer role."""
+        with self._send_buffer_lock:
+            self._send_buffer = []
+            self._send_flushing = False
 
     def _process_worker_queue(self):
-        """Processes messages received from the worker via the queue."""
-        while True:
-            line = self.worker_output_queue.get()
-            if line is None:
-                print("Worker output queue processing stopped.", file=sys.stderr)
-                break # Sentinel value received
+        """Dispatches messages queued by the Windows reader threads, until shutdown.
 
+        The thread outlives worker restarts: it re-reads self.worker_output_queue
+        on every iteration, so a swapped-in queue is picked up after the wakeup.
+        """
+        while not _shutdown_event.is_set():
+            message = self.worker_output_queue.get()
+            if message is None:
+                continue # End of a worker's output, or a wakeup after the queue was swapped
+            self._dispatch_worker_message(message)
+        _dbg("Worker output queue processing stopped.")
+
+    def _dispatch_worker_message(self, message: Dict):
+        """Handles one message received from the worker."""
+        msg_type = message.get("type")
+        session_path = message.get("session")
+
+        # Fast path: stream chunks make up nearly all traffic during a turn
+        if msg_type == "stream" and session_path:
             try:
-                message = json.loads(line)
-                msg_type = message.get("type")
-                session_path = message.get("session")
+                self._flush_stream(session_path, message)
+            except Exception as e:
+                _log.error(f"Error flushing worker stream message: {e}{_exc_detail()}")
+            return
 
-                if not session_path:
-                    print(f"Worker message missing session path: {message}", file=sys.stderr)
-                    continue
+        try:
+            if not session_path:
+                _log.error(f"Worker message missing session path: {message}")
+                return
 
-                # print(f"Processing worker message: {message}", file=sys.stderr) # Debug
+            if msg_type in WORKER_REQUEST_TYPES:
+                # May wait on the user (tool approval) or on Emacs, which must not stall
+                # the reader thread: it also drains the worker's stderr
+                self._worker_request_executor.submit(self._handle_worker_request, session_path, message)
+                return
 
-                if msg_type == "stream":
-                    role = message.get("role", "llm") # e.g., "llm", "user", "tool_json", "tool_json_args"
-                    content = message.get("content", "") # Default to empty string
-                    tool_id = message.get("tool_id") # Present for tool_json roles
-                    tool_name = message.get("tool_name") # Present for tool_json role
+            # print(f"Processing worker message: {message}", file=sys.stderr) # Debug
+
+            if msg_type == "finished":
+                status = message.get("status", "unknown")
+                finish_message = message.get("message", "")
+                _dbg("Worker finished interaction for %s. Status: %s. Message: %s", session_path, status, finish_message)
+
+                # Clear active session *before* processing history or signaling Emacs
+                if self._release_session(session_path): # Mark session as no longer active
+                    _dbg("Cleared active interaction flag for session: %s", session_path)
+
+                # Append final assistant message to history here if needed
+                # If the interaction finished successfully, update the session history
+                if status in ["success", "max_turns_reached"]:
+                    final_history = message.get("final_history")
+                    if final_history and isinstance(final_history, list):
+                        session = self._get_or_create_session(session_path)
+                        if session:
+                            # Filter history content before setting it
+                            filtered_history = []
+                            for msg in final_history:
+                                if isinstance(msg, dict) and "content" in msg:
+                                    filtered_msg = dict(msg) # Copy message
+                                    filtered_msg["content"] = _filter_environment_details(msg["content"])
+                                    filtered_history.append(filtered_msg)
+                                else:
+                                    filtered_history.append(msg) # Keep non-dict or content-less items as is
+
+                            _dbg("Updating session history for %s with %s filtered messages.", session_path, len(filtered_history))
+                            session.set_history(filtered_history) # Use the filtered history
+                            # The worker keeps the same filtered history, later requests only send what's new
+                            self._worker_history[session_path] = (session.history_version, len(session.history))
+                        else:
+                            _log.error(f"Error: Could not find session {session_path} to update history.")
+                    elif status in ["success", "max_turns_reached"]: # Only warn if history was expected
+                        _log.warning(f"Warning: Worker finished successfully but did not provide final history for {session_path}.")
+
+                # Signal Emacs regardless of history update success
+                eval_in_emacs("emigo--agent-finished", session_path)
+                # active_interaction_session is now cleared earlier
+
+            elif msg_type == "error":
+                error_msg = message.get("message", "Unknown error from worker")
+                _log.error(f"Error from worker ({session_path}): {error_msg}")
+                eval_in_emacs("emigo--flush-buffer", session_path, f"[Worker Error: {error_msg}]", "error")
+                # If an error occurs, consider the interaction finished
+                self._release_session(session_path)
+                # Resend the full history next time in case the worker's copy is out of sync
+                self._worker_history.pop(session_path, None)
+
+            # Handle other message types (status, pong, etc.) if needed
+        except Exception as e:
+            _log.error(f"Error processing worker message: {e}{_exc_detail()}")
 
-                    # Filter content *unless* it's a tool argument chunk
-                    if role != "tool_json_args":
-                        filtered_content = _filter_environment_details(content)
-                    else:
-                        filtered_content = content # Pass tool args unfiltered
-
-                    # Flush to Emacs if content is non-empty OR if it's a tool start marker
-                    if filtered_content or role == "tool_json":
-                        # Pass all relevant info to Elisp
-                        eval_in_emacs("emigo--flush-buffer", session_path, filtered_content, role, tool_id, tool_name)
-                    # History is updated via the 'finished' message
-
-                elif msg_type == "tool_request":
-                    tool_call_id = message.get("request_id") # Worker sends tool_call_id as request_id
-                    tool_name = message.get("tool_name")
-                    parameters_dict = message.get("parameters") # Expect 'parameters' dict
-
-                    if tool_call_id and tool_name and isinstance(parameters_dict, dict):
-                        # Store request data before executing, keyed by tool_call_id
-                        self.pending_tool_requests[tool_call_id] = message
-                        # Execute the tool (handles approval internally)
-                        tool_result_str = self._handle_tool_request_from_worker(session_path, tool_name, parameters_dict)
-                        # Send result back to worker, matching request_id (tool_call_id)
-                        self._send_to_worker({
-                            "type": "tool_result",
-                            "request_id": tool_call_id, # Use the tool_call_id received
-                            "result": tool_result_str # Send the actual result string
-                        })
-                        # Clean up pending request
-                        if tool_call_id in self.pending_tool_requests:
-                            del self.pending_tool_requests[tool_call_id]
-                    else:
-                        print(f"Invalid tool_request from worker: {message}", file=sys.stderr)
-                        # Optionally send an error back to the worker?
-                        if tool_call_id:
-                             self._send_to_worker({
-                                 "type": "tool_result",
-                                 "request_id": tool_call_id,
-                                 "result": tools._format_tool_error("Invalid tool_request message received by main process.")
-                             })
-
-                elif msg_type == "finished":
-                    status = message.get("status", "unknown")
-                    finish_message = message.get("message", "")
-                    print(f"Worker finished interaction for {session_path}. Status: {status}. Message: {finish_message}", file=sys.stderr)
-
-                    # Clear active session *before* processing history or signaling Emacs
-                    if self.active_interaction_session == session_path:
-                        self.active_interaction_session = None # Mark session as no longer active
-                        print(f"Cleared active interaction flag for session: {session_path}", file=sys.stderr) # Debug
-
-                    # Append final assistant message to history here if needed
-                    # If the interaction finished successfully, update the session history
-                    if status in ["success", "max_turns_reached"]:
-                        final_history = message.get("final_history")
-                        if final_history and isinstance(final_history, list):
-                            session = self._get_or_create_session(session_path)
-                            if session:
-                                # Filter history content before setting it
-                                filtered_history = []
-                                for msg in final_history:
-                                    if isinstance(msg, dict) and "content" in msg:
-                                        filtered_msg = dict(msg) # Copy message
-                                        filtered_msg["content"] = _filter_environment_details(msg["content"])
-                                        filtered_history.append(filtered_msg)
-                                    else:
-                                        filtered_history.append(msg) # Keep non-dict or content-less items as is
-
-                                print(f"Updating session history for {session_path} with {len(filtered_history)} filtered messages.", file=sys.stderr)
-                                session.set_history(filtered_history) # Use the filtered history
-                            else:
-                                print(f"Error: Could not find session {session_path} to update history.", file=sys.stderr)
-                        elif status in ["success", "max_turns_reached"]: # Only warn if history was expected
-                            print(f"Warning: Worker finished successfully but did not provide final history for {session_path}.", file=sys.stderr)
-
-                    # Signal Emacs regardless of history update success
-                    eval_in_emacs("emigo--agent-finished", session_path)
-                    # active_interaction_session is now cleared earlier
-
-                elif msg_type == "error":
-                    error_msg = message.get("message", "Unknown error from worker")
-                    print(f"Error from worker ({session_path}): {error_msg}", file=sys.stderr)
-                    eval_in_emacs("emigo--flush-buffer", session_path, f"[Worker Error: {error_msg}]", "error")
-                    # If an error occurs, consider the interaction finished
-                    if self.active_interaction_session == session_path:
-                        self.active_interaction_session = None
-
-                elif msg_type == "get_environment_details_request":
-                    request_id = message.get("request_id")
-                    if request_id:
-                        print(f"Worker requested environment details for {session_path}", file=sys.stderr)
-                        details = self._get_environment_details_string(session_path)
-                        self._send_to_worker({
-                            "type": "get_environment_details_response",
-                            "request_id": request_id,
-                            "session": session_path, # Include session for routing if needed
-                            "details": details
-                        })
-                    else:
-                        print(f"Invalid get_environment_details_request from worker (missing request_id): {message}", file=sys.stderr)
+    def _handle_worker_request(self, session_path: str, message: Dict):
+        """Answers a worker message that needs a reply (WORKER_REQUEST_TYPES).
 
+        Runs on the single worker-request thread, in the order the messages arrived.
+        """
+        msg_type = message.get("type")
+        try:
+            if msg_type == "tool_request":
+                tool_call_id = message.get("request_id") # Worker sends tool_call_id as request_id
+                tool_name = message.get("tool_name")
+                parameters_dict = message.get("parameters") # Expect 'parameters' dict
+
+                if tool_call_id and tool_name and isinstance(parameters_dict, dict):
+                    # Execute the tool (handles approval internally). The call is
+                    # synchronous, so the request never needs to be tracked elsewhere.
+                    tool_result_str = self._handle_tool_request_from_worker(session_path, tool_name, parameters_dict)
+                    # Send result back to worker, matching request_id (tool_call_id)
+                    self._send_to_worker({
+                        "type": "tool_result",
+                        "request_id": tool_call_id, # Use the tool_call_id received
+                        "result": tool_result_str # Send the actual result string
+                    })
+                else:
+                    _log.error(f"Invalid tool_request from worker: {message}")
+                    # Optionally send an error back to the worker?
+                    if tool_call_id:
+                         self._send_to_worker({
+                             "type": "tool_result",
+                             "request_id": tool_call_id,
+                             "result": tools._format_tool_error("Invalid tool_request message received by main process.")
+                         })
+
+            elif msg_type == "history_resync":
+                # The worker had no copy of the history a delta was based on (e.g. it was
+                # restarted in between), send the same prompt again with the full history
+                _log.info(f"Worker asked for the full history of {session_path}, resending the request.")
+                self._worker_history.pop(session_path, None)
+                session = self.sessions.get(session_path)
+                if session is None:
+                    self._release_session(session_path)
+                    return
+                self._dispatch_interaction(session, message.get("prompt", ""))
+
+            elif msg_type == "get_environment_details_request":
+                request_id = message.get("request_id")
+                if request_id:
+                    _dbg("Worker requested environment details for %s", session_path)
+                    details = self._get_environment_details_string(session_path)
+                    self._send_to_worker({
+                        "type": "get_environment_details_response",
+                        "request_id": request_id,
+                        "session": session_path, # Include session for routing if needed
+                        "details": details
+                    })
+                else:
+                    _log.error(f"Invalid get_environment_details_request from worker (missing request_id): {message}")
+        except Exception as e:
+            _log.error(f"Error handling worker request {msg_type}: {e}{_exc_detail()}")
 
-                # Handle other message types (status, pong, etc.) if needed
-            except json.JSONDecodeError:
-                print(f"Received invalid JSON from worker queue: {line}", file=sys.stderr)
-            except Exception as e:
-                print(f"Error processing worker queue message: {e}\n{traceback.format_exc()}", file=sys.stderr)
+    def _flush_stream(self, session_path: str, message: Dict):
+        """Forwards a worker 'stream' message to the Emacs buffer."""
+        role = message.get("role", "llm") # e.g., "llm", "user", "tool_json", "tool_json_args"
+        content = message.get("content", "") # Default to empty string
+
+        # Filter content *unless* it's a tool argument chunk
+        if role != "tool_json_args":
+            content = _filter_environment_details(content)
+
+        # Flush to Emacs if content is non-empty OR if it's a tool start marker
+        if content or role == "tool_json":
+            # Pass all relevant info to Elisp; tool_id/tool_name are present for tool_json roles
+            eval_in_emacs("emigo--flush-buffer", session_path, content, role,
+                          message.get("tool_id"), message.get("tool_name"))
+        # History is updated via the 'finished' message
 
     def _handle_tool_request_from_worker(self, session_path: str, tool_name: str, parameters: Dict[str, Any]) -> str:
         """Handles tool execution requested by the worker process."""
-        print(f"Handling tool request from worker: {tool_name} for {session_path} with args: {parameters}", file=sys.stderr)
+        if EMIGO_DEBUG: # Avoid formatting potentially large tool arguments
+            _dbg("Handling tool request from worker: %s for %s with args: %s", tool_name, session_path, parameters)
 
         # Get the session object
         session = self._get_or_create_session(session_path)
@@ -539,28 +962,21 @@ class Emigo:
         if not tool_definition:
             return tools._format_tool_error(f"Unknown tool requested: {tool_name}")
 
-        # Define tools that require explicit approval from Emacs
-        require_approval_list = [
-            TOOL_EXECUTE_COMMAND,
-            TOOL_WRITE_TO_FILE,
-            # Add other tools needing approval if necessary
-        ]
-
         # --- Request Approval from Emacs (Synchronous) ---
-        if tool_name in require_approval_list:
+        if tool_name in REQUIRE_APPROVAL_TOOLS:
             try:
                 # Display parameters as JSON string for approval prompt
                 # Use ensure_ascii=False for better unicode display in Emacs if needed
                 args_display_str = json.dumps(parameters, indent=2, ensure_ascii=False)
-                print(f"Requesting approval for {tool_name} with args:\n{args_display_str}", file=sys.stderr)
+                _dbg("Requesting approval for %s with args:\n%s", tool_name, args_display_str)
                 # Pass the JSON string representation to Elisp
                 is_approved = get_emacs_func_result("request-tool-approval-sync", session_path, tool_name, args_display_str)
 
                 if not is_approved: # Emacs function should return t or nil
-                    print(f"Tool use denied by user: {tool_name}", file=sys.stderr)
+                    _log.info(f"Tool use denied by user: {tool_name}")
                     return TOOL_DENIED
             except Exception as e:
-                print(f"Error requesting tool approval from Emacs: {e}\n{traceback.format_exc()}", file=sys.stderr)
+                _log.error(f"Error requesting tool approval from Emacs: {e}{_exc_detail()}")
                 # Use the tool's error formatter
                 return tools._format_tool_error(f"Error requesting tool approval: {e}")
 
@@ -569,47 +985,106 @@ class Emigo:
         # based on tool_definition['parameters']
 
         # --- Execute Approved Tool ---
-        print(f"Dispatching approved tool: {tool_name}", file=sys.stderr)
+        _dbg("Dispatching approved tool: %s", tool_name)
         tool_function = tool_definition['function']
         try:
             # Pass the parameters dictionary directly to the tool function
             tool_result = tool_function(session, parameters)
         except Exception as e:
             # Catch errors within the tool function itself
-            print(f"Error during execution of tool '{tool_name}': {e}\n{traceback.format_exc()}", file=sys.stderr)
+            _log.error(f"Error during execution of tool '{tool_name}': {e}{_exc_detail()}")
             return tools._format_tool_error(f"Error executing tool '{tool_name}': {e}")
 
         # --- Clear Active Session on Completion ---
         # If the completion tool was called successfully, clear the active session flag *now*
         # so that new prompts aren't rejected while waiting for the worker's 'finished' message.
-        if tool_name == TOOL_ATTEMPT_COMPLETION and tool_result == "COMPLETION_SIGNALLED":
-            if self.active_interaction_session == session_path:
-                print(f"Completion signalled for {session_path}. Clearing active session flag immediately.", file=sys.stderr)
-                self.active_interaction_session = None
+        # == short-circuits on identity for the constant itself and still matches an equal copy
+        if tool_result == TOOL_COMPLETION_SIGNALLED and tool_name == TOOL_ATTEMPT_COMPLETION:
+            if self._release_session(session_path):
+                _dbg("Completion signalled for %s. Clearing active session flag immediately.", session_path)
             else:
                 # This shouldn't happen if logic is correct, but log if it does
-                 print(f"Warning: Completion signalled for {session_path}, but it wasn't the active session ({self.active_interaction_session}).", file=sys.stderr)
+                 _log.warning(f"Warning: Completion signalled for {session_path}, but it wasn't the active session ({self.active_interaction_session}).")
 
         return tool_result
 
+    # --- Interaction State ---
+
+    def _try_claim_session(self, session_path: str) -> bool:
+        """Marks session_path as the active interaction, only if no other interaction is active."""
+        if self._interaction_busy: # Busy: no need to contend for the lock
+            return False
+        with self._session_slot_lock:
+            if self.active_interaction_session is not None:
+                return False
+            self.active_interaction_session = session_path
+            self._interaction_busy = True
+            return True
+
+    def _release_session(self, session_path: str) -> bool:
+        """Clears the active interaction, only if it still belongs to session_path."""
+        with self._session_slot_lock:
+            if self.active_interaction_session != session_path:
+                return False # Stale release, another interaction owns the slot now
+            self.active_interaction_session = None
+            self._interaction_busy = False
+            return True
+
     # --- Session Management ---
 
     def _get_or_create_session(self, session_path: str) -> Optional[Session]:
         """Gets the Session object for a path, creating it if necessary."""
+        # Fast path: existing sessions were validated when they were created
+        session = self.sessions.get(session_path)
+        if session is not None:
+            return session
+
         if not os.path.isdir(session_path):
-            print(f"ERROR: Invalid session path (not a directory): {session_path}", file=sys.stderr)
+            _log.error(f"ERROR: Invalid session path (not a directory): {session_path}")
             # Maybe notify Emacs here?
             eval_in_emacs("message", f"[Emigo Error] Invalid session path: {session_path}")
             return None
 
-        if session_path not in self.sessions:
-            print(f"Creating new session object for: {session_path}", file=sys.stderr)
-            # TODO: Get verbose setting from config
-            self.sessions[session_path] = Session(session_path=session_path, verbose=True)
-        return self.sessions[session_path]
+        with self._sessions_lock: # Concurrent EPC calls must not create two sessions for one path
+            session = self.sessions.get(session_path)
+            if session is None:
+                _dbg("Creating new session object for: %s", session_path)
+                # TODO: Get verbose setting from config
+                session = self.sessions[session_path] = Session(session_path=session_path, verbose=True)
+        return session
+
+    def _get_worker_config(self) -> Optional[List]:
+        """Returns the values of EMACS_CONFIG_VARS, reusing a fetch newer than EMACS_CONFIG_TTL."""
+        cached = self._config_cache
+        now = time.monotonic()
+        if cached and now - cached[0] < EMACS_CONFIG_TTL:
+            return cached[1]
+        vars_result = get_emacs_vars(EMACS_CONFIG_VARS)
+        if vars_result and len(vars_result) == len(EMACS_CONFIG_VARS):
+            self._config_cache = (now, vars_result)
+        return vars_result
+
+    def _history_payload(self, session: Session) -> Dict:
+        """Returns the history fields of an interaction request.
+
+        Only the messages appended since the worker last saw this session's
+        history are sent; anything else (revised, cleared or truncated
+        history, new worker) sends the full history.
+        """
+        history = session.get_history_view()
+        length = len(history)
+        known = self._worker_history.get(session.session_path)
+        self._worker_history[session.session_path] = (session.history_version, length)
+        if known and session.history_reset_version <= known[0] and known[1] <= length:
+            return {"history_base": known[1], "history_delta": history[known[1]:]}
+        return {"history": history} # Serialized right away, no need for a copy
 
     # --- EPC Methods Called by Emacs ---
 
+    def invalidate_config_cache(self):
+        """EPC: Drops the cached model configuration, called when Emacs customizes it."""
+        self._config_cache = None
+
     def get_chat_files(self, session_path: str) -> List[str]:
         """EPC: Returns the list of files currently in the chat context for a session."""
         session = self._get_or_create_session(session_path)
@@ -642,151 +1117,170 @@ class Emigo:
         message_emacs(msg) # Display message (success or error) in Emacs
         return success
 
-    def emigo_send_revised_history(self, session_path: str, revised_history: List[Dict]):
-        """
-        EPC: Handles sending a potentially modified history back to the LLM.
+    def _claim_interaction(self, session_path: str, rerun_with: str, ignored: str) -> bool:
+        """Claims the interaction slot for session_path, offering to cancel a running interaction.
 
-        Args:
-            session_path: The path identifying the session.
-            revised_history: A list of message dictionaries representing the
-                            new history baseline.
+        rerun_with ends the confirmation question ("...re-run with <rerun_with>?") and
+        ignored names what is dropped if the user declines (e.g. "New prompt").
+        Returns True if the slot was claimed.
         """
-        print(f"Received revised history for session: {session_path}", file=sys.stderr)
-
-        if not revised_history:
-            message_emacs("[Emigo Error] Received empty revised history.")
-            return
-
-        # Check for active interaction (similar to emigo_send)
-        if self.active_interaction_session:
-            print(f"Interaction already active for session {self.active_interaction_session}. Asking user about new prompt for {session_path}.", file=sys.stderr)
-            try:
-                confirm_cancel = get_emacs_func_result("yes-or-no-p",
-                                                       "Agent is currently running, do you want to stop it and re-run with the revised history?")
-                if confirm_cancel:
-                    print(f"User confirmed cancellation of {self.active_interaction_session}. Proceeding with revised history for {session_path}.", file=sys.stderr)
-                    if not self.cancel_llm_interaction(self.active_interaction_session):
-                        message_emacs("[Emigo Error] Failed to cancel previous interaction.")
-                        return # Stop if cancellation failed
-                else:
-                    print(f"User declined cancellation. Ignoring revised history for {session_path}.", file=sys.stderr)
-                    eval_in_emacs("message", f"[Emigo] Agent busy with {self.active_interaction_session}. Revised history ignored.")
-                    return
-            except Exception as e:
-                print(f"Error during confirmation/cancellation: {e}\n{traceback.format_exc()}", file=sys.stderr)
-                message_emacs(f"[Emigo Error] Failed to ask for cancellation confirmation: {e}")
-                return
-
-        # Mark session as active
-        self.active_interaction_session = session_path
-
-        session = self._get_or_create_session(session_path)
-        if not session:
-            eval_in_emacs("emigo--flush-buffer", f"invalid-session-{session_path}", f"[Error: Invalid session path '{session_path}']", "error")
-            self.active_interaction_session = None # Clear flag on error
-            return
+        if self._try_claim_session(session_path):
+            return True
 
-        # Convert Elisp plist format (list of lists) to Python list of dicts
-        history_dicts = []
-        if isinstance(revised_history, list):
-            for item in revised_history:
-                if isinstance(item, list) and len(item) == 4 and item[0] == ':role' and item[2] == ':content':
-                    history_dicts.append({'role': item[1], 'content': item[3]})
-                else:
-                    print(f"Warning: Skipping invalid item in revised_history: {item}", file=sys.stderr)
-        else:
-             message_emacs(f"[Emigo Error] Received revised history is not a list: {type(revised_history)}")
-             self.active_interaction_session = None # Clear flag on error
-             return
+        active_session = self.active_interaction_session
+        _log.info(f"Interaction already active for session {active_session}. Asking user about new prompt for {session_path}.")
+        try:
+            # Ask user in Emacs if they want to cancel the active session and proceed
+            confirm_cancel = get_emacs_func_result("yes-or-no-p",
+                                                   f"Agent is currently running, do you want to stop it and re-run with {rerun_with}?")
+            if confirm_cancel:
+                _log.info(f"User confirmed cancellation of {active_session}. Proceeding with {session_path}.")
+                # Cancel the currently active interaction. This also releases the active session.
+                if active_session and self.cancel_llm_interaction(active_session) is False:
+                    message_emacs("[Emigo Error] Failed to cancel previous interaction.")
+                    return False # Stop if cancellation failed
+            else:
+                # User declined, ignore the new request
+                _log.info(f"User declined cancellation. {ignored} ignored for {session_path}.")
+                eval_in_emacs("message", f"[Emigo] Agent busy with {active_session}. {ignored} ignored.")
+                return False
+        except Exception as e:
+            _log.error(f"Error during confirmation/cancellation: {e}{_exc_detail()}")
+            message_emacs(f"[Emigo Error] Failed to ask for cancellation confirmation: {e}")
+            return False
 
+        # The user confirmed cancellation; claim the freed slot for the *new* session.
+        # Another request may have claimed it while the user was asked.
+        if not self._try_claim_session(session_path):
+            eval_in_emacs("message", f"[Emigo] Agent busy with {self.active_interaction_session}. {ignored} ignored.")
+            return False
+        return True
 
-        # Replace the session's history with the *converted* list of dicts
-        print(f"Replacing history for session {session_path} with {len(history_dicts)} revised messages.", file=sys.stderr)
-        session.set_history(history_dicts) # Pass the converted list
+    def _dispatch_interaction(self, session: Session, prompt: str):
+        """Sends an interaction request for the session's current history to the worker.
 
-        # --- Prepare data for worker ---
-        # The 'prompt' is effectively the last message in the revised history (now dicts)
-        last_message_content = history_dicts[-1].get("content", "") if history_dicts else ""
-
-        # Get current state snapshot (history is now the revised one)
-        session_history = session.get_history() # This now returns the revised history
+        The caller holds the interaction slot; it is released if the request can't be sent.
+        """
+        session_path = session.session_path
+        # Get current state snapshot from the session object
         session_chat_files = session.get_chat_files()
+        # Generate environment details string using the session object
         environment_details_str = session.get_environment_details_string()
 
-        # Get model config (same as emigo_send)
-        vars_result = get_emacs_vars(["emigo-model", "emigo-base-url", "emigo-api-key", "emigo-extra-headers"])
-        if not vars_result or len(vars_result) < 3:
+        # Get model config from Emacs vars
+        vars_result = self._get_worker_config()
+        if not vars_result or len(vars_result) < len(EMACS_CONFIG_VARS):
             message_emacs(f"Error retrieving Emacs variables for session {session_path}.")
-            self.active_interaction_session = None
+            self._release_session(session_path) # Unset active session
             return
-        model, base_url, api_key, extra_headers = vars_result
+        model, base_url, api_key, extra_headers, response_cache = vars_result
 
         if not model:
-            message_emacs(f"Please set emigo-model before starting session {session.session_path}.")
-            self.active_interaction_session = None
+            message_emacs(f"Please set emigo-model before starting session {session_path}.")
+            self._release_session(session_path) # Unset active session
+            return
+
+        # Restart a dead worker now rather than in _send_to_worker: a new worker holds no
+        # history yet, so the history fields must be chosen after it is running
+        if not self._ensure_worker_running(session_path):
+            self._release_session(session_path) # Unset active session
             return
 
         worker_config = {
             "model": model,
             "api_key": api_key if api_key else None,
             "base_url": base_url if base_url else None,
-            "verbose": session.verbose
+            "verbose": session.verbose, # Use session's verbose setting
+            "response_cache": bool(response_cache) # Reuse responses to identical requests
         }
 
+        # Prepare the state snapshot for the worker
         request_data = {
-            "session_path": session.session_path,
-            "prompt": last_message_content, # Use last message as nominal prompt
-            "history": session_history, # Pass the revised history snapshot
+            "session_path": session_path, # Use absolute path from session
+            "prompt": prompt, # Still useful for context, though history is primary
+            **self._history_payload(session), # History snapshot, or just its new tail
             "config": worker_config,
-            "chat_files": session_chat_files,
-            "environment_details": environment_details_str,
-            "extra_headers": extra_headers
+            "chat_files": session_chat_files, # Pass chat files snapshot
+            "environment_details": environment_details_str, # Pass generated details,
+            "extra_headers": extra_headers # Include any extra headers
         }
 
-       # --- Send request to worker ---
-        print(f"Sending revised interaction request to worker for session {session.session_path}", file=sys.stderr)
+        # --- Send request to worker ---
+        _dbg("Sending interaction request to worker for session %s", session_path)
         self._send_to_worker({
             "type": "interaction_request",
             "data": request_data
         })
-        # Response handling happens asynchronously
+        # The response handling happens asynchronously on the worker reader thread
 
-    def emigo_send(self, session_path: str, prompt: str):
-        """EPC: Handles a user prompt by initiating an interaction with the LLM worker."""
-        print(f"Received prompt for session: {session_path}: {prompt}", file=sys.stderr)
+    def emigo_send_revised_history(self, session_path: str, revised_history: List[Dict]):
+        """
+        EPC: Handles sending a potentially modified history back to the LLM.
 
-        # Check if another interaction is already running
-        if self.active_interaction_session:
-            print(f"Interaction already active for session {self.active_interaction_session}. Asking user about new prompt for {session_path}.", file=sys.stderr)
-            try:
-                # Ask user in Emacs if they want to cancel the active session and proceed
-                confirm_cancel = get_emacs_func_result("yes-or-no-p",
-                                                       "Agent is currently running, do you want to stop it and re-run with your new prompt?")
-
-                if confirm_cancel:
-                    print(f"User confirmed cancellation of {self.active_interaction_session}. Proceeding with {session_path}.", file=sys.stderr)
-                    # Cancel the currently active interaction. This also resets self.active_interaction_session.
-                    self.cancel_llm_interaction(self.active_interaction_session)
-                else:
-                    # User declined, ignore the new prompt
-                    print(f"User declined cancellation. Ignoring new prompt for {session_path}.", file=sys.stderr)
-                    eval_in_emacs("message", f"[Emigo] Agent busy with {self.active_interaction_session}. New prompt ignored.")
-                    return # Stop processing the new prompt
+        Args:
+            session_path: The path identifying the session.
+            revised_history: A list of message dictionaries representing the
+                            new history baseline.
+        """
+        _dbg("Received revised history for session: %s", session_path)
 
-            except Exception as e:
-                print(f"Error during confirmation/cancellation: {e}\n{traceback.format_exc()}", file=sys.stderr)
-                message_emacs(f"[Emigo Error] Failed to ask for cancellation confirmation: {e}")
-                return # Stop processing on error
+        if not revised_history:
+            message_emacs("[Emigo Error] Received empty revised history.")
+            return
 
-        # If we reach here, either no interaction was active, or the user confirmed cancellation.
-        # Mark the *new* session as active.
-        self.active_interaction_session = session_path
+        # Check for active interaction and mark session as active
+        if not self._claim_interaction(session_path, "the revised history", "Revised history"):
+            return
+
+        session = self._get_or_create_session(session_path)
+        if not session:
+            eval_in_emacs("emigo--flush-buffer", f"invalid-session-{session_path}", f"[Error: Invalid session path '{session_path}']", "error")
+            self._release_session(session_path) # Clear flag on error
+            return
+
+        # Convert Elisp plist format (list of (:role r :content c) lists) to Python list of dicts
+        if not isinstance(revised_history, list):
+             message_emacs(f"[Emigo Error] Received revised history is not a list: {type(revised_history)}")
+             self._release_session(session_path) # Clear flag on error
+             return
+        try:
+            # emigo--parse-history-buffer always builds (:role r :content c), so just pick the values
+            history_dicts = [{'role': role, 'content': content}
+                             for role, content in map(_PLIST_ROLE_CONTENT, revised_history)]
+        except (IndexError, TypeError):
+            # Malformed input: fall back to validating each item, skipping the invalid ones
+            history_dicts = [{'role': item[1], 'content': item[3]} for item in revised_history
+                             if isinstance(item, list) and len(item) == 4
+                             and item[0] == ':role' and item[2] == ':content']
+            _log.warning(f"Warning: Skipped {len(revised_history) - len(history_dicts)} invalid item(s) in revised_history.")
+
+        # Replace the session's history with the *converted* list of dicts, unless nothing was revised
+        if session.history_matches(history_dicts):
+            # Keeping the current history also keeps fields the buffer doesn't show (e.g. tool_call_id)
+            _dbg("Revised history for session %s is unchanged, keeping it.", session_path)
+        else:
+            _dbg("Replacing history for session %s with %s revised messages.", session_path, len(history_dicts))
+            session.set_history(history_dicts) # Pass the converted list
+
+        # The 'prompt' is effectively the last message in the revised history (now dicts)
+        last_message_content = history_dicts[-1].get("content", "") if history_dicts else ""
+        self._dispatch_interaction(session, last_message_content)
+
+    def emigo_send(self, session_path: str, prompt: str):
+        """EPC: Handles a user prompt by initiating an interaction with the LLM worker."""
+        if EMIGO_DEBUG:
+            _dbg("Received prompt for session: %s: %s", session_path, prompt)
+
+        # Mark the session as active, unless another interaction is already running
+        if not self._claim_interaction(session_path, "your new prompt", "New prompt"):
+            return
 
         # Get or create the session object
         session = self._get_or_create_session(session_path)
         if not session:
             # Error already logged by _get_or_create_session
             eval_in_emacs("emigo--flush-buffer", f"invalid-session-{session_path}", f"[Error: Invalid session path '{session_path}']", "error")
+            self._release_session(session_path)
             return
 
         # Flush the user prompt to the Emacs buffer first
@@ -795,87 +1289,41 @@ class Emigo:
         session.append_history({"role": "user", "content": prompt})
 
         # --- Handle File Mentions (@file) ---
-        mention_pattern = r'@(\S+)'
-        mentioned_files_in_prompt = re.findall(mention_pattern, prompt)
+        # Most prompts have no mentions at all, skip the fence stripping and regex for those
+        if "@" in prompt:
+            # dict.fromkeys drops repeated mentions while keeping their order
+            mention_text = CODE_FENCE_RE.sub(" ", prompt) if "```" in prompt else prompt
+            mentioned_files_in_prompt = list(dict.fromkeys(match.group(1) for match in MENTION_RE.finditer(mention_text)))
+        else:
+            mentioned_files_in_prompt = []
         # Use the session object's method to add files
         if mentioned_files_in_prompt:
-            print(f"Found file mentions in prompt: {mentioned_files_in_prompt}", file=sys.stderr)
+            _dbg("Found file mentions in prompt: %s", mentioned_files_in_prompt)
             for file in mentioned_files_in_prompt:
+                if session.has_file_in_context(file):
+                    continue # Already added, skip the filesystem checks
                 success, msg = session.add_file_to_context(file)
                 if success:
                     message_emacs(msg) # Notify Emacs only on successful add
 
-        # --- Prepare data for worker ---
-        # Get current state snapshot from the session object
-        session_history = session.get_history()
-        session_chat_files = session.get_chat_files()
-        # Generate environment details string using the session object
-        environment_details_str = session.get_environment_details_string()
-
-        # Get model config from Emacs vars
-        vars_result = get_emacs_vars(["emigo-model", "emigo-base-url", "emigo-api-key", "emigo-extra-headers"])
-        if not vars_result or len(vars_result) < 3:
-            message_emacs(f"Error retrieving Emacs variables for session {session_path}.")
-            self.active_interaction_session = None # Unset active session
-            return
-        model, base_url, api_key, extra_headers = vars_result
-
-        if not model:
-            message_emacs(f"Please set emigo-model before starting session {session.session_path}.")
-            self.active_interaction_session = None # Unset active session
-            return
-
-        worker_config = {
-            "model": model,
-            "api_key": api_key if api_key else None,
-            "base_url": base_url if base_url else None,
-            "verbose": session.verbose # Use session's verbose setting
-        }
-
-        # Prepare the state snapshot for the worker
-        request_data = {
-            "session_path": session.session_path, # Use absolute path from session
-            "prompt": prompt, # Still useful for context, though history is primary
-            "history": session_history, # Pass history snapshot
-            "config": worker_config,
-            "chat_files": session_chat_files, # Pass chat files snapshot
-            "environment_details": environment_details_str, # Pass generated details,
-            "extra_headers": extra_headers # Include any extra headers
-        }
-
-        # --- Send request to worker ---
-        print(f"Sending interaction request to worker for session {session.session_path}", file=sys.stderr)
-        self._send_to_worker({
-            "type": "interaction_request",
-            "data": request_data
-        })
-        # The response handling happens asynchronously in _process_worker_queue
+        self._dispatch_interaction(session, prompt)
 
     def cancel_llm_interaction(self, session_path: str):
         """Cancels the current LLM interaction by killing and restarting the worker."""
-        print(f"Received request to cancel interaction for session: {session_path}", file=sys.stderr)
+        _log.info(f"Received request to cancel interaction for session: {session_path}")
         # Check if the cancellation request is for the currently active session
         if self.active_interaction_session != session_path:
             message_emacs(f"No active interaction found for session {session_path} to cancel.")
             return
 
-        print("Stopping and restarting LLM worker due to cancellation request...", file=sys.stderr)
-        self._stop_llm_worker()
+        _log.info("Stopping and restarting LLM worker due to cancellation request...")
+        # Swap in a fresh queue first, so messages from the worker being stopped are dropped in one step
+        with self.llm_worker_lock:
+            stale_queue, self.worker_output_queue = self.worker_output_queue, queue.Queue()
+        stale_queue.put(None) # Wake the processor thread so it moves to the new queue
+        _dbg("Discarded worker output queue (~%s stale messages).", stale_queue.qsize())
 
-        # Drain the queue to discard messages from the stopped worker
-        print("Draining worker output queue...", file=sys.stderr)
-        drained_count = 0
-        while not self.worker_output_queue.empty():
-            try:
-                _ = self.worker_output_queue.get_nowait()
-                # print(f"Discarding stale message: {stale_msg}", file=sys.stderr) # Optional: very verbose
-                drained_count += 1
-            except queue.Empty:
-                break
-            except Exception as e:
-                print(f"Error draining queue: {e}", file=sys.stderr)
-                break # Stop draining on error
-            print(f"Worker output queue drained ({drained_count} messages discarded).", file=sys.stderr)
+        self._stop_llm_worker()
 
         self._start_llm_worker()
         # Check if worker restart was successful before proceeding
@@ -885,68 +1333,57 @@ class Emigo:
                 worker_restarted_ok = True
 
         if not worker_restarted_ok:
-            print("ERROR: Failed to restart LLM worker after cancellation.", file=sys.stderr)
+            _log.error("ERROR: Failed to restart LLM worker after cancellation.")
             message_emacs("[Emigo Error] Failed to restart LLM worker after cancellation.")
             # Clear active session state even on failure
-            self.active_interaction_session = None
-            self.pending_tool_requests.clear()
-            return False # Indicate failure
-
-        print("LLM worker restarted successfully.", file=sys.stderr)
-
-        # --- Restart the worker queue processor thread ---
-        print("Restarting worker queue processor thread...", file=sys.stderr)
-        self.worker_processor_thread = threading.Thread(target=self._process_worker_queue, name="WorkerQueueProcessorThread", daemon=True)
-        self.worker_processor_thread.start()
-        if not self.worker_processor_thread.is_alive():
-            print("ERROR: Failed to restart worker queue processor thread.", file=sys.stderr)
-            message_emacs("[Emigo Error] Failed to restart worker queue processor thread.")
-            # Stop the worker again if the processor fails
-            self._stop_llm_worker()
-            self.active_interaction_session = None
-            self.pending_tool_requests.clear()
+            self._release_session(session_path)
             return False # Indicate failure
-        print("Worker queue processor thread restarted.", file=sys.stderr)
-        # --- End restart queue processor ---
 
+        _dbg("LLM worker restarted successfully.")
 
         # Remove the last user message (the cancelled prompt) from history
         session = self.sessions.get(session_path)
         if session and session.history:
-            # History is stored as (timestamp, message_dict)
-            last_timestamp, last_message = session.history[-1]
-            if last_message.get("role") == "user":
-                print(f"Removing cancelled user prompt from history for {session_path}", file=sys.stderr)
-                session.history.pop()
+            if session.pop_last_if_user():
+                _dbg("Removed cancelled user prompt from history for %s", session_path)
             else:
-                print(f"Warning: Last message in history for cancelled session {session_path} was not from user.", file=sys.stderr)
+                _log.warning(f"Warning: Last message in history for cancelled session {session_path} was not from user.")
 
         # Clear active session state
-        self.active_interaction_session = None
-        # Clear any pending tool requests that belonged to the killed worker's task
-        self.pending_tool_requests.clear()
+        self._release_session(session_path)
 
         # Invalidate the cache for the cancelled session to ensure fresh context next time
         if session:
-            print(f"Invalidating cache for cancelled session: {session_path}", file=sys.stderr)
+            _dbg("Invalidating cache for cancelled session: %s", session_path)
             session.invalidate_cache()
         else:
-            print(f"Warning: Could not find session {session_path} to invalidate cache after cancellation.", file=sys.stderr)
+            _log.warning(f"Warning: Could not find session {session_path} to invalidate cache after cancellation.")
 
         # Notify Emacs buffer
         eval_in_emacs("emigo--flush-buffer", session_path, "\n[Interaction cancelled by user.]\n", "warning")
         return True # Indicate success
 
     def cleanup(self):
-        """Do some cleanup before exit python process."""
-        print("Running Emigo cleanup...", file=sys.stderr)
+        """Do some cleanup before exit python process. Runs once, later calls return immediately."""
+        with self._cleanup_lock:
+            if self._cleaned_up:
+                return
+            self._cleaned_up = True
+        _dbg("Running Emigo cleanup...")
         self._stop_llm_worker()
+        self._worker_request_executor.shutdown(wait=False)
         close_epc_client()
-        print("Emigo cleanup finished.", file=sys.stderr)
+        # Called on an EPC handler thread or the main thread, never on the one running serve_forever
+        self.server.shutdown()
+        self.server.server_close()
+        _dbg("Emigo cleanup finished.")
+        _shutdown_event.set() # Wake the main thread so the process exits
+        self.worker_output_queue.put(None) # Let the queue processor thread see the shutdown
+        _stop_profiler() # Here rather than on exit, Emacs kills the process right after this call
 
     def clear_history(self, session_path: str) -> bool:
         """EPC: Clear the chat history for the given session path."""
-        print(f"Clearing history for session: {session_path}", file=sys.stderr)
+        _dbg("Clearing history for session: %s", session_path)
         session = self._get_or_create_session(session_path)
         if session:
             session.clear_history()
@@ -960,20 +1397,23 @@ class Emigo:
 
 
 if __name__ == "__main__":
-    print("emigo.py starting execution...", file=sys.stderr, flush=True) # DEBUG + flush
+    _dbg("emigo.py starting execution...")
     if len(sys.argv) < 2:
         print("ERROR: Missing EPC server port argument.", file=sys.stderr, flush=True)
         sys.exit(1)
+    if "profile" in sys.argv[2:]:
+        _start_profiler()
+    # On SIGTERM wake the main thread, so the process exits normally and atexit runs cleanup()
+    signal.signal(signal.SIGTERM, lambda signum, frame: _shutdown_event.set())
     try:
-        print("Initializing Emigo class...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Initializing Emigo class...")
         emigo = Emigo(sys.argv[1:])
-        print("Emigo class initialized.", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo class initialized.")
 
         # Keep the main thread alive. Instead of joining the server thread (which might exit),
-        # just wait indefinitely or until interrupted.
-        print("Main thread entering wait loop (Ctrl+C to exit)...", file=sys.stderr, flush=True) # DEBUG + flush
-        while True:
-            time.sleep(3600) # Sleep for a long time, wake up periodically if needed
+        # park until cleanup() is called or we are interrupted.
+        _dbg("Main thread waiting for shutdown (Ctrl+C to exit)...")
+        _shutdown_event.wait()
 
     except KeyboardInterrupt:
         print("\nKeyboardInterrupt received, cleaning up...", file=sys.stderr, flush=True)
@@ -990,4 +1430,5 @@ if __name__ == "__main__":
                 print(f"Error during cleanup: {cleanup_err}", file=sys.stderr, flush=True)
                 sys.exit(1) # Exit with error code
     finally:
-        print("emigo.py main execution finished.", file=sys.stderr, flush=True) # DEBUG + flush
+        _stop_profiler()
+        _dbg("emigo.py main execution finished.")
@@ -17,6 +17,7 @@ import importlib
 import json
 import os
 import sys
+import threading
 import time
 import warnings
 from typing import Dict, Iterator, List, Optional, Union # Removed Tuple
@@ -38,10 +39,13 @@ VERBOSE_LLM_LOADING = False # Set to True for debugging litellm loading
 class LazyLiteLLM:
     """Lazily loads the litellm library upon first access."""
     _lazy_module = None
+    # Held while loading, so a caller arriving during the worker's warm-up
+    # waits for that load instead of importing and configuring a second time
+    _load_lock = threading.Lock()
 
     def __getattr__(self, name):
         # Avoid infinite recursion during initialization
-        if name == "_lazy_module":
+        if name in ("_lazy_module", "_load_lock"):
             return super().__getattribute__(name)
 
         self._load_litellm()
@@ -51,23 +55,30 @@ class LazyLiteLLM:
         """Loads and configures the litellm module."""
         if self._lazy_module is not None:
             return
+        with self._load_lock:
+            if self._lazy_module is None:
+                self._load_litellm_locked()
 
+    def _load_litellm_locked(self):
+        """Imports and configures litellm; the caller holds _load_lock."""
         if VERBOSE_LLM_LOADING:
             print("Loading litellm...", file=sys.stderr)
         start_time = time.time()
 
         try:
-            self._lazy_module = importlib.import_module("litellm")
+            module = importlib.import_module("litellm")
 
             # Basic configuration similar to Aider
-            self._lazy_module.suppress_debug_info = True
-            self._lazy_module.set_verbose = False
-            self._lazy_module.drop_params = True # Drop unsupported params silently
+            module.suppress_debug_info = True
+            module.set_verbose = False
+            module.drop_params = True # Drop unsupported params silently
             # Attempt to disable internal debugging/logging if method exists
-            if hasattr(self._lazy_module, "_logging") and hasattr(
-                self._lazy_module._logging, "_disable_debugging"
+            if hasattr(module, "_logging") and hasattr(
+                module._logging, "_disable_debugging"
             ):
-                self._lazy_module._logging._disable_debugging()
+                module._logging._disable_debugging()
+            # Published only once configured, the unlocked fast path must not see it half set up
+            self._lazy_module = module
 
         except ImportError as e:
             print(
@@ -29,15 +29,24 @@ import json
 import time
 import traceback
 import os
+import threading
+from collections import deque
 
-from utils import _filter_environment_details
-from llm import LLMClient
+if __name__ == "__main__":
+    # Indicate worker is ready before the heavy imports below (agent/repomapper, diskcache,
+    # litellm); emigo.py waits for this line after starting us, and requests sent while
+    # the imports run simply wait in the stdin pipe
+    print(json.dumps({"type": "status", "status": "ready"}), flush=True)
+
+from utils import _filter_environment_details, parse_json_content, dump_json_content
+from llm import LLMClient, litellm
 from agent import Agent
 # Import tool definitions and provider formatting
-from tool_definitions import get_all_tools
+from tool_definitions import get_all_tools, TOOL_READ_FILE
 from llm_providers import get_formatted_tools
+from response_cache import response_cache_key, get_cached_response, store_response, replay_response
 # Import constants used for tool results
-from config import TOOL_DENIED, TOOL_ERROR_PREFIX
+from config import TOOL_DENIED, TOOL_ERROR_PREFIX, TOOL_COMPLETION_SIGNALLED, TOOL_RESULT_SUCCESS
 
 # Add project root to sys.path to allow importing other modules like llm, agent, utils
 project_root = os.path.dirname(os.path.abspath(__file__))
@@ -46,24 +55,104 @@ if project_root not in sys.path:
 
 # --- Communication Functions ---
 
+# Items of a batch message from the main process that have not been handled yet
+_pending_messages = deque()
+
+def read_message():
+    """Reads the next message from the main process, or returns None once stdin is closed.
+
+    Batch messages ({"type": "batch", "items": [...]}) are unwrapped and their
+    items returned one by one. Raises json.JSONDecodeError (which orjson's
+    error subclasses) on invalid input.
+    """
+    if _pending_messages:
+        return _pending_messages.popleft()
+    line = sys.stdin.readline()
+    if not line:
+        return None
+    message = parse_json_content(line) # orjson, matching what emigo.py writes
+    if message.get("type") == "batch":
+        _pending_messages.extend(message.get("items", []))
+        return _pending_messages.popleft() if _pending_messages else {}
+    return message
+
+# Streamed LLM text is held back briefly and sent as one "stream" message,
+# so a fast stream costs one pipe write and one Emacs redisplay per batch
+# rather than per token.
+STREAM_FLUSH_INTERVAL = 0.03 # Seconds queued text may wait before it is sent, even if the stream pauses
+STREAM_FLUSH_CHARS = 4096 # Pending text size that forces a flush
+_stream_parts = []
+_stream_chars = 0
+_stream_session = None
+_stream_last_flush = 0.0
+_stream_timer = None # Deadline flush armed while text is queued
+# Held while queuing/flushing text and writing to stdout: the deadline flush runs on a
+# timer thread, and its stream message must not interleave with or overtake other messages
+_stream_lock = threading.RLock()
+
+def send_stream_text(session_path, content):
+    """Queues a piece of streamed LLM text, flushing it once enough time or text has accumulated."""
+    global _stream_chars, _stream_session, _stream_timer
+    with _stream_lock:
+        if _stream_parts and _stream_session != session_path:
+            flush_stream_text()
+        _stream_session = session_path
+        _stream_parts.append(content)
+        _stream_chars += len(content)
+        delay = _stream_last_flush + STREAM_FLUSH_INTERVAL - time.monotonic()
+        if _stream_chars >= STREAM_FLUSH_CHARS or delay <= 0:
+            flush_stream_text()
+        elif _stream_timer is None:
+            # If no more text arrives (slow provider, pause before a tool call), send it at the deadline anyway
+            _stream_timer = threading.Timer(delay, flush_stream_text)
+            _stream_timer.daemon = True
+            _stream_timer.start()
+
+def flush_stream_text():
+    """Sends any queued LLM text as a single stream message."""
+    global _stream_chars, _stream_last_flush, _stream_timer
+    with _stream_lock:
+        if _stream_timer is not None:
+            _stream_timer.cancel() # No-op when called from the timer itself
+            _stream_timer = None
+        if not _stream_parts:
+            return
+        content = "".join(_stream_parts)
+        _stream_parts.clear()
+        _stream_chars = 0
+        _stream_last_flush = time.monotonic()
+        send_message("stream", _stream_session, role="llm", content=content)
+
+def _write_message(message):
+    """Writes message to stdout as one line of UTF-8 JSON (emigo.py reads stdout as UTF-8)."""
+    try:
+        data = dump_json_content(message)
+    except TypeError: # orjson is stricter about types, let json try its conversions
+        data = json.dumps(message).encode("utf-8")
+    sys.stdout.buffer.write(data + b"\n")
+    sys.stdout.buffer.flush()
+
 def send_message(msg_type, session_path, **kwargs):
-    """Sends a JSON message to stdout for the main process."""
+    """Sends a JSON message to stdout for the main process.
+    Queued LLM text is flushed first so messages keep their order."""
     message = {"type": msg_type, "session": session_path, **kwargs}
-    try:
-        print(json.dumps(message), flush=True)
-    except TypeError as e:
-        # Handle potential non-serializable data in kwargs
-        print(json.dumps({
-            "type": "error",
-            "session": session_path,
-            "message": f"Serialization error: {e}. Data: {repr(kwargs)}"
-        }), flush=True)
-    except Exception as e:
-        print(json.dumps({
-            "type": "error",
-            "session": session_path,
-            "message": f"Error sending message: {e}"
-        }), flush=True)
+    with _stream_lock:
+        flush_stream_text()
+        try:
+            _write_message(message)
+        except TypeError as e:
+            # Handle potential non-serializable data in kwargs
+            print(json.dumps({
+                "type": "error",
+                "session": session_path,
+                "message": f"Serialization error: {e}. Data: {repr(kwargs)}"
+            }), flush=True)
+        except Exception as e:
+            print(json.dumps({
+                "type": "error",
+                "session": session_path,
+                "message": f"Error sending message: {e}"
+            }), flush=True)
 
 
 def request_tool_execution(session_path, tool_name, parameters_dict):
@@ -74,29 +163,77 @@ def request_tool_execution(session_path, tool_name, parameters_dict):
     # Wait for the corresponding tool_result from stdin
     while True:
         try:
-            line = sys.stdin.readline()
-            if not line:
+            response = read_message()
+            if response is None:
                 # Main process likely closed stdin, worker should exit
                 send_message("error", session_path, message="Stdin closed unexpectedly. Exiting.")
                 sys.exit(1)
-            response = json.loads(line)
             if response.get("type") == "tool_result" and response.get("request_id") == request_id:
                 return response.get("result")
-        except json.JSONDecodeError:
-            send_message("error", session_path, message=f"Worker received invalid JSON from stdin: {line.strip()}")
+        except json.JSONDecodeError as e:
+            send_message("error", session_path, message=f"Worker received invalid JSON from stdin: {e.doc.strip()}")
             # Continue waiting, maybe the next line is valid
         except Exception as e:
             send_message("error", session_path, message=f"Error reading tool result from stdin: {e}")
             # Return an error state to the agent logic
             return f"<tool_error>Error receiving tool result: {e}</tool_error>"
 
+# --- History Sync ---
+
+# Per-session copy of the history this worker last received or sent back,
+# so emigo.py only has to send the messages added since then.
+_session_histories = {}
+
+def resolve_request_history(request):
+    """Returns the request's history as a list of message dicts, or None if out of sync.
+
+    The request carries either the full "history" or a "history_delta" to be
+    appended to the first "history_base" messages this worker already holds.
+    The returned list is the worker's stored copy; callers must not modify it.
+    """
+    session_path = request.get("session_path")
+    if "history_delta" in request:
+        history = _session_histories.get(session_path)
+        if history is None or len(history) != request.get("history_base"):
+            return None
+        history.extend(msg_dict for _, msg_dict in request["history_delta"])
+    else:
+        history = [msg_dict for _, msg_dict in request.get("history", [])] # List of (timestamp, message_dict)
+        _session_histories[session_path] = history
+    return history
+
+def remember_final_history(session_path, final_history):
+    """Stores the history emigo.py will keep after this interaction (filtered like Session.set_history)."""
+    _session_histories[session_path] = [
+        dict(msg, content=_filter_environment_details(msg["content"]))
+        for msg in final_history
+        if isinstance(msg, dict) and "role" in msg and "content" in msg
+    ]
+
+# Provider-formatted tool definitions per model name; the tool registry is fixed at import
+_formatted_tools_by_model = {}
+
+def formatted_tools_for(model_name):
+    """Returns the tool definitions formatted for model_name, built on first use."""
+    formatted_tools = _formatted_tools_by_model.get(model_name)
+    if formatted_tools is None:
+        formatted_tools = get_formatted_tools(get_all_tools(), model_name) # From tool_definitions / llm_providers
+        _formatted_tools_by_model[model_name] = formatted_tools
+    return formatted_tools
+
 # --- Agent Logic Adaptation ---
 
+def _file_request_signature(tool_calls):
+    """Returns the frozenset of requested paths if every call is a read_file, otherwise None."""
+    if not tool_calls or any(tool_name != TOOL_READ_FILE for _, tool_name, _ in tool_calls):
+        return None
+    return frozenset(parameters.get("path") for _, _, parameters in tool_calls)
+
 def handle_interaction_request(request):
     """Handles a single interaction request dictionary."""
     session_path = request.get("session_path")
     prompt = request.get("prompt")
-    history = request.get("history", []) # List of (timestamp, message_dict)
+    history = resolve_request_history(request) # List of message dicts
     config = request.get("config", {})
     chat_files_list = request.get("chat_files", [])
     environment_details_str = request.get("environment_details", "<environment_details>\n# Error: Details not provided by main process.\n</environment_details>") # Get details from request
@@ -104,6 +241,10 @@ def handle_interaction_request(request):
     if not all([session_path, prompt]):
         send_message("error", session_path or "unknown", message="Worker received incomplete request.")
         return
+    if history is None:
+        # No copy of the history the delta is based on, ask for the full history instead
+        send_message("history_resync", session_path, prompt=prompt)
+        return
 
     # --- Initialize LLM Client ---
     # Get config from request data
@@ -130,8 +271,9 @@ def handle_interaction_request(request):
     # Create a temporary chat_files dict for this request instance (still needed for Agent init?)
     # Agent class might not need chat_files_ref anymore if env details are pre-built.
     # Let's keep it for now in case Agent uses it for other things.
-    # The main process owns the canonical chat_files state
-    current_chat_files = {session_path: list(chat_files_list)}
+    # The main process owns the canonical chat_files state; the list was just decoded
+    # from the request and nothing else holds it, so no copy is needed
+    current_chat_files = {session_path: chat_files_list}
 
     # NOTE: This creates a new Agent instance for *every* request because
     # the worker might be killed. If the worker were persistent, we might
@@ -151,7 +293,10 @@ def handle_interaction_request(request):
 
     # Override the agent's communication methods to use our send_message function
     def stream_to_main_process(content, role="llm"):
-        send_message("stream", session_path, role=role, content=content)
+        if role == "llm":
+            send_stream_text(session_path, content)
+        else:
+            send_message("stream", session_path, role=role, content=content)
 
     # Override the agent's tool execution to use our request_tool_execution function
     def execute_tool_via_main_process(tool_name, params):
@@ -163,8 +308,8 @@ def handle_interaction_request(request):
 
     # --- Run the Agent Interaction Loop ---
     # Keep track of history *during* this interaction locally
-    # Start with a copy of the history received from the main process
-    interaction_history = [msg_dict for _, msg_dict in history] # Extract dicts
+    # Start with a copy of the history received from the main process (the only copy made)
+    interaction_history = list(history)
 
     try:
         # Build system prompt
@@ -176,7 +321,18 @@ def handle_interaction_request(request):
         # Signal start of interaction
         send_message("stream", session_path, role="llm", content="\nAssistant:\n")
 
+        # Get available tools formatted for the provider, they are the same for every turn
+        formatted_tools = formatted_tools_for(llm_client.model_name)
+
+        # Prepare arguments for llm_client.send
+        completion_args = {"stream": True}
+        if formatted_tools:
+            completion_args["tools"] = formatted_tools
+            completion_args["tool_choice"] = "auto" # Or make configurable if needed
+
         max_turns = 10  # Limit turns to prevent infinite loops
+        last_file_request = None # _file_request_signature of the previous turn
+        answered_file_request = False # Whether a repeat of last_file_request was already answered locally
         for turn in range(max_turns):
             print(f"Worker: Agent Turn {turn + 1}/{max_turns}", file=sys.stderr)
 
@@ -184,24 +340,25 @@ def handle_interaction_request(request):
             messages_to_send = agent._prepare_llm_prompt(system_prompt, interaction_history) # Pass the list of dicts
 
             # 2. Call LLM (directly using llm_client)
-            full_response_text = "" # Accumulate the textual response
+            response_parts = [] # Accumulate the textual response, joined once after streaming
             tool_call_fragments = {} # {index: {"id": str, "type": str, "function": {"name": str, "arguments": str}}}
             started_tool_calls = set() # Keep track of tool_ids for which 'tool_json' has been sent
             llm_error_occurred = False # Flag to track LLM errors
 
             try:
-                # Get available tools and format them for the provider
-                available_tools = get_all_tools() # From tool_definitions
-                formatted_tools = get_formatted_tools(available_tools, llm_client.model_name) # From llm_providers
-
-                # Prepare arguments for llm_client.send
-                completion_args = {"stream": True}
-                if formatted_tools:
-                    completion_args["tools"] = formatted_tools
-                    completion_args["tool_choice"] = "auto" # Or make configurable if needed
-
-                # Call llm_client directly, enabling streaming and passing tools
-                response_stream = llm_client.send(messages_to_send, **completion_args)
+                # Reuse the response to an identical earlier request if enabled, else call llm_client
+                # directly, enabling streaming and passing tools
+                cache_key = None
+                cached_response = None
+                if config.get("response_cache"):
+                    cache_key = response_cache_key(llm_client.model_name, messages_to_send, formatted_tools)
+                    cached_response = get_cached_response(cache_key)
+                if cached_response is not None:
+                    print("Worker: Replaying cached LLM response.", file=sys.stderr)
+                    response_stream = replay_response(cached_response)
+                    cache_key = None # Already stored
+                else:
+                    response_stream = llm_client.send(messages_to_send, **completion_args)
 
                 # Stream text chunks and accumulate tool calls
                 for chunk in response_stream:
@@ -246,7 +403,7 @@ def handle_interaction_request(request):
                         if hasattr(delta, 'content') and delta.content:
                             content_piece = delta.content
                             stream_to_main_process(content_piece) # Stream text content
-                            full_response_text += content_piece # Accumulate text
+                            response_parts.append(content_piece) # Accumulate text
                     except Exception as e:
                          print(f"  - Error processing delta.content: {e}. Delta: {delta}", file=sys.stderr)
                          # Continue processing other parts if possible
@@ -300,6 +457,11 @@ def handle_interaction_request(request):
                          print(f"  - Error processing delta.tool_calls: {e}. Delta: {delta}", file=sys.stderr)
                          # Continue processing other parts if possible
 
+                flush_stream_text() # Don't hold the tail of the response back
+                if cache_key and not llm_error_occurred:
+                    store_response(cache_key, "".join(response_parts),
+                                   [tool_call_fragments[index] for index in sorted(tool_call_fragments)])
+
             except Exception as e:
                 llm_error_occurred = True # Set flag
                 error_message = f"[Error during LLM communication or streaming: {e}]\n{traceback.format_exc()}"
@@ -380,6 +542,7 @@ def handle_interaction_request(request):
             # Include reconstructed tool calls if any were generated
             if not llm_error_occurred:
                 assistant_message = {"role": "assistant"}
+                full_response_text = "".join(response_parts)
                 filtered_response_text = _filter_environment_details(full_response_text.strip())
                 # Add content only if it's non-empty after filtering
                 if filtered_response_text:
@@ -399,6 +562,28 @@ def handle_interaction_request(request):
                      interaction_history.append({"role": "assistant", "content": ""})
 
 
+            # A turn that only re-reads the files the previous turn just added would get the
+            # same results; answer it here without the tool round-trips and let the LLM
+            # answer with what it has. If it asks a third time, stop and say why.
+            file_request = None if llm_error_occurred else _file_request_signature(tool_calls_extracted)
+            if file_request is not None and file_request == last_file_request:
+                requested = ', '.join(sorted(map(str, file_request)))
+                interaction_history.extend({
+                    "role": "tool",
+                    "tool_call_id": tool_call_id,
+                    "name": tool_name,
+                    "content": f"{TOOL_RESULT_SUCCESS}\nFile '{parameters_dict.get('path')}' is already in context, its content is in <environment_details>."
+                } for tool_call_id, tool_name, parameters_dict in tool_calls_extracted)
+                if answered_file_request:
+                    print(f"Worker: LLM kept re-requesting files already in context ({requested}), ending interaction.", file=sys.stderr)
+                    stream_to_main_process(f"\n[Stopped: the model kept requesting files that are already in context ({requested}).]\n", "error")
+                    break
+                print(f"Worker: LLM re-requested files already in context ({requested}), answered locally.", file=sys.stderr)
+                answered_file_request = True
+                continue
+            last_file_request = file_request
+            answered_file_request = False
+
             # 4. Execute Tools (if any calls were successfully *parsed* and no LLM error)
             should_continue_interaction = True # Assume continuation unless tool signals otherwise
             # Add logging before the check
@@ -413,32 +598,18 @@ def handle_interaction_request(request):
                     tool_result_str = request_tool_execution(session_path, tool_name, parameters_dict)
 
                     # --- Check raw tool_result_str for signals BEFORE filtering ---
-                    if tool_result_str == "COMPLETION_SIGNALLED":
-                        print(f"Worker: Completion signalled by tool {tool_name}. Ending interaction.", file=sys.stderr)
-                        should_continue_interaction = False
-                        # Add the signalling result to history before breaking
-                        tool_results_for_history.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call_id,
-                            "name": tool_name,
-                            "content": tool_result_str
-                        })
-                        break # Stop processing further tools
+                    if tool_result_str == TOOL_COMPLETION_SIGNALLED:
+                        end_reason = "Completion signalled by tool"
                     elif tool_result_str == TOOL_DENIED: # Use constant
-                        print(f"Worker: Tool {tool_name} denied by user. Ending interaction.", file=sys.stderr)
-                        should_continue_interaction = False
-                        # Add the denial result to history before breaking
-                        tool_results_for_history.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call_id,
-                            "name": tool_name,
-                            "content": tool_result_str
-                        })
-                        break # Stop processing further tools
+                        end_reason = "Denied by user"
                     elif tool_result_str.startswith(TOOL_ERROR_PREFIX): # Use constant
-                        print(f"Worker: Tool {tool_name} failed. Ending interaction. Result: {tool_result_str}", file=sys.stderr)
+                        end_reason = f"Tool failed. Result: {tool_result_str}"
+                    else:
+                        end_reason = None
+                    if end_reason is not None:
+                        print(f"Worker: {tool_name}: {end_reason}. Ending interaction.", file=sys.stderr)
                         should_continue_interaction = False
-                         # Add the error result to history before breaking
+                        # Add the signal/denial/error result to history unfiltered before breaking
                         tool_results_for_history.append({
                             "role": "tool",
                             "tool_call_id": tool_call_id,
@@ -465,12 +636,11 @@ def handle_interaction_request(request):
                     print("Worker: Ending interaction loop due to tool result (completion, denial, error).", file=sys.stderr)
                     break # Exit the turn loop
 
-                # 7. Fetch updated environment details ONLY if continuing
-                if should_continue_interaction: # Check flag before fetching
-                    print("Worker: Requesting updated environment details for next turn...", file=sys.stderr)
-                    updated_env_details = request_environment_details(session_path)
-                    agent.environment_details_str = updated_env_details # Update agent's state
-                    print("Worker: Updated environment details received.", file=sys.stderr)
+                # 7. Fetch updated environment details, we only get here if continuing
+                print("Worker: Requesting updated environment details for next turn...", file=sys.stderr)
+                updated_env_details = request_environment_details(session_path)
+                agent.environment_details_str = updated_env_details # Update agent's state
+                print("Worker: Updated environment details received.", file=sys.stderr)
 
             # Check if interaction should end because no *parsed* tools were called
             # or if an LLM error occurred.
@@ -516,6 +686,7 @@ def handle_interaction_request(request):
         # Include the final history state unless there was an LLM error
         if status != "llm_error":
             finish_data["final_history"] = interaction_history # Send back the list of dicts
+            remember_final_history(session_path, interaction_history)
 
         send_message("finished", session_path, **finish_data)
 
@@ -532,29 +703,37 @@ def handle_interaction_request(request):
 
 # --- Main Worker Loop ---
 
+def _warm_up():
+    """Loads litellm and the cl100k_base tokenizer data ahead of the first request."""
+    try:
+        litellm._load_litellm()
+        import tiktoken
+        tiktoken.get_encoding("cl100k_base") # Cached by tiktoken, Agent's get_encoding is then cheap
+    except BaseException as e: # Includes the SystemExit _load_litellm raises, the first request reports it properly
+        print(f"Worker: Warm-up failed: {e}", file=sys.stderr)
+
 def main():
     """Reads requests from stdin and handles them."""
-    # Indicate worker is ready (optional)
-    # print(json.dumps({"type": "status", "status": "ready"}), flush=True)
+    # Load the slow imports while the user is still typing the first prompt
+    threading.Thread(target=_warm_up, name="WorkerWarmUp", daemon=True).start()
 
     while True:
         try:
-            line = sys.stdin.readline()
-            if not line:
+            request = read_message()
+            if request is None:
                 # End of input, exit gracefully
                 # print(json.dumps({"type": "status", "status": "exiting", "reason": "stdin closed"}), flush=True)
                 break
 
-            request = json.loads(line)
             if request.get("type") == "interaction_request":
                 handle_interaction_request(request.get("data"))
             elif request.get("type") == "ping": # Example control message
                 send_message("pong", request.get("session", "control"))
                 # Handle other control messages if needed (e.g., shutdown)
 
-        except json.JSONDecodeError:
+        except json.JSONDecodeError as e:
             # Log error but try to continue reading
-             print(json.dumps({"type": "error", "session":"unknown", "message": f"Worker received invalid JSON: {line.strip()}"}), flush=True)
+             print(json.dumps({"type": "error", "session":"unknown", "message": f"Worker received invalid JSON: {e.doc.strip()}"}), flush=True)
         except Exception as e:
             # Log unexpected errors
             tb_str = traceback.format_exc()
@@ -570,15 +749,14 @@ def request_environment_details(session_path):
     # Wait for the corresponding response from stdin
     while True:
         try:
-            line = sys.stdin.readline()
-            if not line:
+            response = read_message()
+            if response is None:
                 send_message("error", session_path, message="Stdin closed unexpectedly while waiting for env details. Exiting.")
                 sys.exit(1)
-            response = json.loads(line)
             if response.get("type") == "get_environment_details_response" and response.get("request_id") == request_id:
                 return response.get("details", "") # Return details string or empty
-        except json.JSONDecodeError:
-            send_message("error", session_path, message=f"Worker received invalid JSON from stdin while waiting for env details: {line.strip()}")
+        except json.JSONDecodeError as e:
+            send_message("error", session_path, message=f"Worker received invalid JSON from stdin while waiting for env details: {e.doc.strip()}")
         except Exception as e:
             send_message("error", session_path, message=f"Error reading env details result from stdin: {e}")
             return f"<environment_details>\n# Error receiving details: {e}\n</environment_details>" # Return error state
@@ -51,6 +51,9 @@ from config import ( # Import centralized lists
     NORMALIZED_ROOT_IMPORTANT_FILES
 )
 
+# All IGNORED_DIRS patterns in one alternation, matched once per directory
+_IGNORED_DIRS_RE = re.compile("|".join(f"(?:{pattern})" for pattern in IGNORED_DIRS))
+
 # tree_sitter is throwing a FutureWarning
 warnings.simplefilter("ignore", category=FutureWarning)
 try:
@@ -920,12 +923,12 @@ class RepoMapper:
             print(f"Scanning directory: {directory}", file=sys.stderr)
         for root, dirs, files in os.walk(directory, topdown=True):
             # Filter directories
-            # Use imported IGNORED_DIRS from config (as regex patterns)
+            # Use imported IGNORED_DIRS from config (as one combined regex)
             dirs[:] = [
                 d for d in dirs
                 if not (
                     d.startswith('.') or # Ignore hidden directories
-                    any(re.match(pattern, d) for pattern in IGNORED_DIRS) # Check against regex patterns
+                    _IGNORED_DIRS_RE.match(d)
                 )
             ]
 
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exact-match cache of LLM responses for the worker process.
+
+A response is keyed by the model name, the full message list and the tool
+definitions sent with it, so it is only reused when the LLM would see exactly
+the same request again. Entries hold the streamed text and the reconstructed
+tool calls; `replay_response` turns them back into stream chunks with the
+same shape as litellm's, so the worker's streaming loop handles a cache hit
+like any other response.
+
+Enabled from Emacs with `emigo-response-cache`. The cache lives on disk (via
+`diskcache`, like the repo map tags cache) under RESPONSE_CACHE_DIR.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional
+
+from diskcache import Cache
+
+from utils import dump_json_content
+
+RESPONSE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "emigo", "responses")
+RESPONSE_CACHE_SIZE_LIMIT = 256 * 1024 * 1024 # Bytes on disk before diskcache evicts old entries
+
+_cache = None # Opened on first use; False once opening failed
+
+def _get_cache():
+    """Returns the on-disk cache, or None if it can't be opened."""
+    global _cache
+    if _cache is None:
+        try:
+            _cache = Cache(RESPONSE_CACHE_DIR, size_limit=RESPONSE_CACHE_SIZE_LIMIT)
+        except Exception as e:
+            print(f"Response cache disabled, could not open {RESPONSE_CACHE_DIR}: {e}", file=sys.stderr)
+            _cache = False
+    return _cache or None
+
+def response_cache_key(model_name: str, messages: List[Dict], tools: Optional[List[Dict]]) -> str:
+    """Returns the cache key for a request to model_name."""
+    request = [model_name, messages, tools]
+    try:
+        payload = dump_json_content(request, sort_keys=True)
+    except TypeError: # orjson is stricter about types, let json try its conversions
+        payload = json.dumps(request, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+def get_cached_response(key: str) -> Optional[Dict]:
+    """Returns the cached {"text": str, "tool_calls": [...]} for key, or None."""
+    cache = _get_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.get(key)
+    except Exception as e:
+        print(f"Response cache read failed: {e}", file=sys.stderr)
+        return None
+
+def store_response(key: str, text: str, tool_calls: List[Dict]):
+    """Stores a complete response; tool_calls are {"id", "type", "function": {"name", "arguments"}} dicts."""
+    cache = _get_cache()
+    if cache is None:
+        return
+    try:
+        cache.set(key, {"text": text, "tool_calls": tool_calls})
+    except Exception as e:
+        print(f"Response cache write failed: {e}", file=sys.stderr)
+
+def _chunk(content=None, tool_calls=None):
+    """Builds a stream chunk shaped like litellm's (chunk.choices[0].delta)."""
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))])
+
+def replay_response(entry: Dict) -> Iterator:
+    """Yields a cached response as stream chunks: the text first, then one chunk per tool call."""
+    if entry.get("text"):
+        yield _chunk(content=entry["text"])
+    for index, call in enumerate(entry.get("tool_calls", [])):
+        function = call.get("function", {})
+        yield _chunk(tool_calls=[SimpleNamespace(
+            index=index,
+            id=call.get("id"),
+            type=call.get("type", "function"),
+            function=SimpleNamespace(name=function.get("name"), arguments=function.get("arguments", ""))
+        )])
@@ -23,25 +23,86 @@ Key Responsibilities:
 
 import sys
 import os
+import functools
 import time
+import threading
 import tiktoken
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from repomapper import RepoMapper
 from utils import (
      eval_in_emacs, _filter_environment_details, read_file_content
  )
 
+# Seconds a generated environment details string that includes the file listing
+# is reused before being rebuilt. With a repo map, the details only depend on the
+# chat files, so they are reused for as long as those files' mtimes are unchanged.
+# Mutations that affect the details invalidate it immediately.
+ENV_DETAILS_TTL = 1.0
+
+# Seconds the result of checking a file for add_file_to_context is reused
+CONTEXT_FILE_CHECK_TTL = 5.0
+
+def _is_within(root: str, abs_path: str) -> bool:
+    """Returns True if abs_path is root or below it; both must already be absolute and normalized."""
+    # normcase is a no-op on POSIX; on Windows it makes the check case-insensitive like the filesystem
+    root, abs_path = os.path.normcase(root), os.path.normcase(abs_path)
+    return abs_path == root or abs_path.startswith(root.rstrip(os.sep) + os.sep)
+
+class _ContextFileRejected(Exception):
+    """Raised by _resolve_context_file with (rel_filename, message); lru_cache doesn't keep exceptions."""
+
+@functools.lru_cache(maxsize=4096)
+def _resolve_context_file(session_root: str, filename: str, _ttl_bucket: int) -> str:
+    """Resolves filename against session_root (absolute and normalized, see
+    Session.abs_session_path) and returns it relative to the root if it can be
+    added to the context.
+
+    Only successful checks are memoized: _ttl_bucket is just part of the cache
+    key, so they expire after CONTEXT_FILE_CHECK_TTL, while a rejected file is
+    checked again on the next call (it may have been created since). Raises
+    _ContextFileRejected, or ValueError for a path on another drive.
+    """
+    # Expand user directory
+    filename = os.path.expanduser(filename)
+    # Ensure filename is relative to session_path for consistency
+    rel_filename = os.path.relpath(filename, session_root)
+    # Check if file exists and is within session path (session_root is already absolute, normpath is enough)
+    abs_path = os.path.normpath(os.path.join(session_root, rel_filename))
+
+    if not os.path.isfile(abs_path):
+        raise _ContextFileRejected(rel_filename, f"File not found: {rel_filename}")
+    if not _is_within(session_root, abs_path):
+        raise _ContextFileRejected(rel_filename, f"File is outside session directory: {rel_filename}")
+    return rel_filename
+
+def _check_context_file(session_root: str, filename: str, ttl_bucket: int) -> Tuple[str, Optional[str]]:
+    """Returns (rel_filename, error message or None) for _resolve_context_file."""
+    try:
+        return _resolve_context_file(session_root, filename, ttl_bucket), None
+    except _ContextFileRejected as e:
+        return e.args
+
+def _trimmed(content):
+    """Strips string content the way the Emacs history buffer does, other values are returned as is."""
+    return content.strip() if isinstance(content, str) else content
+
 class Session:
     """Encapsulates the state and operations for a single Emigo session."""
 
     def __init__(self, session_path: str, verbose: bool = False):
         self.session_path = session_path
+        self.abs_session_path = os.path.abspath(session_path) # Normalized once, for path checks
         self.verbose = verbose
         self.history: List[Tuple[float, Dict]] = [] # List of (timestamp, message_dict)
-        self.chat_files: List[str] = [] # List of relative file paths
+        self.history_version = 0 # Bumped on every history change
+        self.history_reset_version = 0 # history_version of the last change that was not an append
+        self._history_lock = threading.Lock() # Guards history mutations across EPC and worker threads
+        self.chat_files: Dict[str, None] = {} # Relative file paths, insertion-ordered keys for O(1) membership
         # Caches for file content, mtimes, and the last generated repomap
         self.caches: Dict[str, any] = {'mtimes': {}, 'contents': {}, 'last_repomap': None}
+        # (monotonic timestamp, chat files mtime key, details string) of the last environment details built
+        self._env_cache: Optional[Tuple[float, Tuple, str]] = None
         # RepoMapper instance specific to this session
         # TODO: Get map_tokens and tokenizer from config?
         self.repo_mapper = RepoMapper(root_dir=self.session_path, verbose=self.verbose)
@@ -53,6 +114,14 @@ class Session:
         """Returns the chat history for this session."""
         return list(self.history) # Return a copy
 
+    def get_history_view(self) -> Sequence[Tuple[float, Dict]]:
+        """Returns the history list itself, without copying. Callers must not modify it.
+
+        set_history and clear_history swap in a new list rather than changing
+        this one, so a view only ever grows by appends.
+        """
+        return self.history
+
     def append_history(self, message: Dict):
         """Appends a message with a timestamp to the history."""
         if "role" not in message or "content" not in message:
@@ -61,38 +130,54 @@ class Session:
         # Filter content before appending
         filtered_message = dict(message) # Create a copy
         filtered_message["content"] = _filter_environment_details(filtered_message["content"])
-        self.history.append((time.time(), filtered_message)) # Store filtered copy
+        with self._history_lock:
+            self.history.append((time.time(), filtered_message)) # Store filtered copy
+            self.history_version += 1
+
+    def pop_last_if_user(self) -> bool:
+        """Removes the last history message if it is from the user. Returns whether it did."""
+        with self._history_lock:
+            if not self.history or self.history[-1][1].get("role") != "user":
+                return False
+            self.history = self.history[:-1] # New list, views handed out stay unchanged
+            self._history_reset()
+            return True
 
     def clear_history(self):
         """Clears the chat history for this session."""
-        self.history = []
+        with self._history_lock:
+            self.history = []
+            self._history_reset()
         # Note: Clearing the Emacs buffer is handled separately by the main process calling Elisp
 
     def get_chat_files(self) -> List[str]:
         """Returns the list of files currently in the chat context."""
         return list(self.chat_files) # Return a copy
 
+    def has_file_in_context(self, filename: str) -> bool:
+        """Returns True if filename (as accepted by add_file_to_context) is already in the chat context."""
+        try:
+            rel_filename = os.path.relpath(os.path.expanduser(filename), self.abs_session_path)
+        except ValueError: # Different drive on Windows, can't be in context
+            return False
+        return rel_filename in self.chat_files
+
     def add_file_to_context(self, filename: str) -> Tuple[bool, str]:
         """
         Adds a file to the chat context. Ensures it's relative and exists.
         Returns (success: bool, message: str).
         """
         try:
-            # Expand user directory)
-            filename = os.path.expanduser(filename)          
-            # Ensure filename is relative to session_path for consistency
-            rel_filename = os.path.relpath(filename, self.session_path)
-            # Check if file exists and is within session path
-            abs_path = os.path.abspath(os.path.join(self.session_path, rel_filename))
-
-            if not os.path.isfile(abs_path):
-                 return False, f"File not found: {rel_filename}"
-            if not abs_path.startswith(os.path.abspath(self.session_path)):
-                 return False, f"File is outside session directory: {rel_filename}"
+            # Repeat mentions of the same file within CONTEXT_FILE_CHECK_TTL skip the stat calls
+            ttl_bucket = int(time.monotonic() // CONTEXT_FILE_CHECK_TTL)
+            rel_filename, error = _check_context_file(self.abs_session_path, filename, ttl_bucket)
+            if error:
+                 return False, error
 
             # Add to context if not already present
             if rel_filename not in self.chat_files:
-                self.chat_files.append(rel_filename)
+                self.chat_files[rel_filename] = None
+                self._env_cache = None
 
                 # Update chat files information to Emacs.
                 self._update_chat_files_info()
@@ -116,14 +201,15 @@ class Session:
         # Ensure filename is relative for comparison
         if os.path.isabs(filename):
             try:
-                rel_filename = os.path.relpath(filename, self.session_path)
+                rel_filename = os.path.relpath(filename, self.abs_session_path)
             except ValueError: # filename might be on a different drive on Windows
                 return False, f"Cannot remove file from different drive: {filename}"
         else:
             rel_filename = filename # Assume it's already relative
 
         if rel_filename in self.chat_files:
-            self.chat_files.remove(rel_filename)
+            del self.chat_files[rel_filename]
+            self._env_cache = None
 
             # Update chat files information to Emacs.
             self._update_chat_files_info()
@@ -162,10 +248,11 @@ class Session:
 
     def _update_file_cache(self, rel_path: str, content: Optional[str] = None) -> bool:
         """Updates the cache (mtime, content) for a given relative file path."""
-        abs_path = os.path.abspath(os.path.join(self.session_path, rel_path))
+        abs_path = os.path.normpath(os.path.join(self.abs_session_path, rel_path))
         try:
             current_mtime = self.repo_mapper.repo_mapper.get_mtime(abs_path) # Access inner RepoMap
             if current_mtime is None: # File deleted or inaccessible
+                self._env_cache = None
                 if rel_path in self.caches['mtimes']:
                     del self.caches['mtimes'][rel_path]
                 if rel_path in self.caches['contents']:
@@ -187,11 +274,13 @@ class Session:
             # Update cache
             self.caches['mtimes'][rel_path] = current_mtime
             self.caches['contents'][rel_path] = content
+            self._env_cache = None
 
             return True
 
         except Exception as e:
             print(f"Error updating cache for '{rel_path}': {e}", file=sys.stderr)
+            self._env_cache = None
             # Invalidate cache on error
             if rel_path in self.caches['mtimes']:
                 del self.caches['mtimes'][rel_path]
@@ -205,7 +294,31 @@ class Session:
             return self.caches['contents'].get(rel_path)
         return None # Return None if update failed (e.g., file deleted)
 
+    def _chat_files_mtime_key(self) -> Tuple:
+        """Returns (rel_path, mtime) for every chat file, mtime None if it can't be stat'ed."""
+        key = []
+        session_path = self.session_path
+        getmtime, join = os.path.getmtime, os.path.join
+        for rel_path in self.chat_files:
+            try:
+                mtime = getmtime(join(session_path, rel_path))
+            except OSError:
+                mtime = None
+            key.append((rel_path, mtime))
+        return tuple(key)
+
     def get_environment_details_string(self) -> str:
+        """Returns the environment details, reusing the last result while it is still valid."""
+        now = time.monotonic()
+        key = self._chat_files_mtime_key()
+        cached = self._env_cache
+        if cached and cached[1] == key and (self.caches['last_repomap'] or now - cached[0] < ENV_DETAILS_TTL):
+            return cached[2]
+        details = self._build_environment_details_string()
+        self._env_cache = (now, key, details)
+        return details
+
+    def _build_environment_details_string(self) -> str:
         """Fetches environment details: repo map OR file listing, plus file contents."""
         details = "<environment_details>\n"
         details += f"# Session Directory\n{self.session_path.replace(os.sep, '/')}\n\n" # Use POSIX path
@@ -219,11 +332,17 @@ class Session:
             details += "# File/Directory Structure (use list_repomap tool for code summary)\n"
             try:
                 # Use RepoMapper's file finding logic for consistency
-                all_files = self.repo_mapper._find_src_files(self.session_path) # Find files respecting ignores
+                all_files = self.repo_mapper._find_src_files(self.abs_session_path) # Find files respecting ignores
+                # Files are found under the normalized root, so stripping the prefix gives the relative path
+                root_prefix = self.abs_session_path.rstrip(os.sep) + os.sep
                 tree_lines = []
                 processed_dirs = set()
                 for abs_file in sorted(all_files):
-                    rel_file = os.path.relpath(abs_file, self.session_path).replace(os.sep, '/')
+                    if abs_file.startswith(root_prefix):
+                        rel_file = abs_file[len(root_prefix):]
+                    else:
+                        rel_file = os.path.relpath(abs_file, self.abs_session_path)
+                    rel_file = rel_file.replace(os.sep, '/')
                     parts = rel_file.split('/')
                     current_path_prefix = ""
                     for i, part in enumerate(parts[:-1]): # Iterate through directories
@@ -244,17 +363,20 @@ class Session:
                 details += f"# Error listing files/directories: {str(e)}\n\n"
 
         # --- List Added Files and Content ---
-        if self.chat_files:
-            details += "# Files Currently in Chat Context\n"
-            # Clean up session cache for files no longer in chat_files list
-            current_chat_files_set = set(self.chat_files)
-            for rel_path in list(self.caches['mtimes'].keys()):
-                if rel_path not in current_chat_files_set:
-                    del self.caches['mtimes'][rel_path]
-                    if rel_path in self.caches['contents']:
-                        del self.caches['contents'][rel_path]
-
-            for rel_path in sorted(self.chat_files): # Sort for consistent order
+        # Bound once: these are touched for every file below
+        chat_files = self.chat_files
+        mtimes = self.caches['mtimes']
+        contents = self.caches['contents']
+        if chat_files:
+            # File sections are collected and joined once, contents can be large
+            sections = ["# Files Currently in Chat Context\n"]
+            # Clean up session cache for files no longer in chat_files
+            for rel_path in list(mtimes):
+                if rel_path not in chat_files:
+                    del mtimes[rel_path]
+                    contents.pop(rel_path, None)
+
+            for rel_path in sorted(chat_files): # Sort for consistent order
                 posix_rel_path = rel_path.replace(os.sep, '/')
                 try:
                     # Get content, updating cache if needed
@@ -263,15 +385,14 @@ class Session:
                         content = f"# Error: Could not read or cache {posix_rel_path}\n"
 
                     # Use markdown code block for file content
-                    details += f"## File: {posix_rel_path}\n```\n{content}\n```\n\n"
+                    sections.append(f"## File: {posix_rel_path}\n```\n{content}\n```\n\n")
 
                 except Exception as e:
-                    details += f"## File: {posix_rel_path}\n# Error reading file: {e}\n\n"
+                    sections.append(f"## File: {posix_rel_path}\n# Error reading file: {e}\n\n")
                     # Clean up potentially stale cache entries on error
-                    if rel_path in self.caches['mtimes']:
-                        del self.caches['mtimes'][rel_path]
-                    if rel_path in self.caches['contents']:
-                        del self.caches['contents'][rel_path]
+                    mtimes.pop(rel_path, None)
+                    contents.pop(rel_path, None)
+            details += "".join(sections)
 
         details += "</environment_details>"
         return details
@@ -279,9 +400,11 @@ class Session:
     def set_last_repomap(self, map_content: str):
         """Stores the latest generated repomap content."""
         self.caches['last_repomap'] = map_content
+        self._env_cache = None
 
     def invalidate_cache(self, rel_path: Optional[str] = None):
         """Invalidates cache for a specific file or the entire session."""
+        self._env_cache = None
         if rel_path:
             if rel_path in self.caches['mtimes']:
                 del self.caches['mtimes'][rel_path]
@@ -298,16 +421,39 @@ class Session:
 
     def set_history(self, history_dicts: List[Dict]):
         """Replaces the current history with the provided list of message dictionaries."""
-        self.history = [] # Clear existing history
+        new_history = []
+        self._env_cache = None
         for msg_dict in history_dicts:
             if "role" in msg_dict and "content" in msg_dict:
                 # Filter content before appending
                 filtered_message = dict(msg_dict) # Create a copy
                 filtered_message["content"] = _filter_environment_details(filtered_message["content"])
                  # Add with current timestamp, store filtered copy
-                self.history.append((time.time(), filtered_message))
+                new_history.append((time.time(), filtered_message))
             else:
                 print(f"Warning: Skipping invalid message dict during set_history: {msg_dict}", file=sys.stderr)
+        with self._history_lock:
+            self.history = new_history # Replace existing history
+            self._history_reset()
+
+    def history_matches(self, history_dicts: List[Dict]) -> bool:
+        """Returns True if history_dicts has the same roles and (trimmed) contents as the history.
+
+        Compares from the end, where revisions usually are, so a mismatch exits early.
+        """
+        history = self.history
+        if len(history_dicts) != len(history):
+            return False
+        for msg_dict, (_, message) in zip(reversed(history_dicts), reversed(history)):
+            if (msg_dict.get("role") != message.get("role")
+                    or _trimmed(msg_dict.get("content")) != _trimmed(message.get("content"))):
+                return False
+        return True
+
+    def _history_reset(self):
+        """Records a history change that is not a plain append (caller holds _history_lock)."""
+        self.history_version += 1
+        self.history_reset_version = self.history_version
 
 
 # Example usage (for testing if run directly)
@@ -38,7 +38,20 @@ from utils import get_emacs_func_result, eval_in_emacs, read_file_content
 # Import system prompt constants for standard messages/prefixes
 from config import (
     TOOL_RESULT_SUCCESS, TOOL_RESULT_OUTPUT_PREFIX,
-    TOOL_DENIED, TOOL_ERROR_PREFIX, TOOL_ERROR_SUFFIX
+    TOOL_DENIED, TOOL_ERROR_PREFIX, TOOL_ERROR_SUFFIX, TOOL_COMPLETION_SIGNALLED
+)
+
+SEARCH_MARKER = "<<<<<<< SEARCH\n"
+DIVIDER_MARKER = "\n=======\n"
+REPLACE_MARKER = "\n>>>>>>> REPLACE"
+# Compiled once; matches every SEARCH/REPLACE block non-greedily
+SEARCH_REPLACE_RE = re.compile(
+    re.escape(SEARCH_MARKER) +
+    '(.*?)' +  # Capture search text (non-greedy)
+    re.escape(DIVIDER_MARKER) +
+    '(.*?)' +  # Capture replace text (non-greedy)
+    re.escape(REPLACE_MARKER),
+    re.DOTALL  # Allow '.' to match newlines
 )
 
 # --- Helper Functions ---
@@ -53,8 +66,8 @@ def _format_tool_error(error_message: str) -> str:
     return f"{TOOL_ERROR_PREFIX}{error_message}{TOOL_ERROR_SUFFIX}"
 
 def _resolve_path(session_path: str, rel_path: str) -> str:
-    """Resolves a relative path within the session path."""
-    return os.path.abspath(os.path.join(session_path, rel_path))
+    """Resolves a relative path within the session path (which must be absolute, see Session.abs_session_path)."""
+    return os.path.normpath(os.path.join(session_path, rel_path))
 
 def _posix_path(path: str) -> str:
     """Converts a path to use POSIX separators."""
@@ -83,10 +96,16 @@ def read_file(session: Session, parameters: Dict[str, Any]) -> str:
     if not rel_path:
         return _format_tool_error("Missing required parameter 'path'")
 
-    abs_path = _resolve_path(session.session_path, rel_path)
+    abs_path = _resolve_path(session.abs_session_path, rel_path)
     posix_rel_path = _posix_path(rel_path)
 
     try:
+        # Re-reading a file already in context only needs its cache refreshed, which stats it once
+        if session.has_file_in_context(abs_path):
+            if not session._update_file_cache(os.path.relpath(abs_path, session.abs_session_path)):
+                return _format_tool_error(f"File not found: {posix_rel_path}")
+            return _format_tool_result(f"File '{posix_rel_path}' read and added to context.")
+
         if not os.path.isfile(abs_path):
              return _format_tool_error(f"File not found: {posix_rel_path}")
 
@@ -118,7 +137,7 @@ def write_to_file(session: Session, parameters: Dict[str, Any]) -> str:
     if content is None: # Check if content is None (missing)
         return _format_tool_error("Missing required parameter 'content'")
 
-    abs_path = _resolve_path(session.session_path, rel_path)
+    abs_path = _resolve_path(session.abs_session_path, rel_path)
     posix_rel_path = _posix_path(rel_path)
 
     try:
@@ -154,21 +173,9 @@ def _parse_search_replace_blocks(diff_str: str) -> Tuple[List[Tuple[str, str]],
         - A list of (search_text, replace_text) tuples for each valid block found.
         - An error message string if parsing fails, otherwise None.
     """
-    search_marker = "<<<<<<< SEARCH\n"
-    divider_marker = "\n=======\n"
-    replace_marker = "\n>>>>>>> REPLACE"
+    search_marker, divider_marker, replace_marker = SEARCH_MARKER, DIVIDER_MARKER, REPLACE_MARKER
     blocks = []
-    # Use regex to find all blocks non-greedily
-    pattern = re.compile(
-        re.escape(search_marker) +
-        '(.*?)' +  # Capture search text (non-greedy)
-        re.escape(divider_marker) +
-        '(.*?)' +  # Capture replace text (non-greedy)
-        re.escape(replace_marker),
-        re.DOTALL  # Allow '.' to match newlines
-    )
-
-    found_blocks_raw = pattern.findall(diff_str)
+    found_blocks_raw = SEARCH_REPLACE_RE.findall(diff_str)
 
     if not found_blocks_raw:
         # Check for common markdown fence if no blocks found
@@ -202,7 +209,7 @@ def replace_in_file(session: Session, parameters: Dict[str, str]) -> str:
     diff_str = parameters.get("diff")
     similarity_threshold = 0.85 # Configurable threshold (85%)
 
-    abs_path = os.path.abspath(os.path.join(session.session_path, rel_path))
+    abs_path = _resolve_path(session.abs_session_path, rel_path)
     posix_rel_path = rel_path.replace(os.sep, '/')
 
     try:
@@ -420,7 +427,7 @@ def attempt_completion(session: Session, parameters: Dict[str, Any]) -> str:
         eval_in_emacs("emigo--signal-completion", session.session_path, result_text, command or "")
         # This tool use itself doesn't return content to the LLM, it ends the loop.
         # Return a special marker that the main process/worker can check.
-        return "COMPLETION_SIGNALLED"
+        return TOOL_COMPLETION_SIGNALLED
     except Exception as e:
         print(f"Error signalling completion to Emacs: {e}", file=sys.stderr)
         return _format_tool_error(f"Error signalling completion: {e}")
@@ -429,7 +436,7 @@ def list_repomap(session: Session, parameters: Dict[str, Any]) -> str:
     """Generates and caches the repository map, potentially focusing on a path."""
     # Get the optional path parameter, default to session root '.'
     rel_path = parameters.get("path", ".")
-    abs_path = _resolve_path(session.session_path, rel_path)
+    abs_path = _resolve_path(session.abs_session_path, rel_path)
     posix_rel_path = _posix_path(rel_path)
 
     try:
@@ -438,7 +445,7 @@ def list_repomap(session: Session, parameters: Dict[str, Any]) -> str:
             return _format_tool_error(f"Path is not a valid directory: {posix_rel_path}")
 
         chat_files = session.get_chat_files()
-        print(f"Generating repomap for {session.session_path}, focusing on '{posix_rel_path}' with chat files: {chat_files}", file=sys.stderr)
+        print(f"Generating repomap for {session.session_path}, focusing on '{posix_rel_path}' with {len(chat_files)} chat files", file=sys.stderr)
 
         # --- TODO: Enhance RepoMapper ---
         # Currently, session.repo_mapper.generate_map likely maps the whole root.
@@ -470,7 +477,7 @@ def list_files(session: Session, parameters: Dict[str, Any]) -> str:
     if not isinstance(recursive, bool):
         recursive = str(recursive).lower() == "true"
 
-    abs_path = _resolve_path(session.session_path, rel_path)
+    abs_path = _resolve_path(session.abs_session_path, rel_path)
     posix_rel_path = _posix_path(rel_path)
     try:
         # Use Emacs function to list files respecting ignores etc.
@@ -506,7 +513,7 @@ def search_files(session: Session, parameters: Dict[str, Any]) -> str:
     if not isinstance(case_sensitive, bool):
         case_sensitive = str(case_sensitive).lower() == "true"
 
-    abs_path = _resolve_path(session.session_path, rel_path)
+    abs_path = _resolve_path(session.abs_session_path, rel_path)
     posix_rel_path = _posix_path(rel_path)
     search_scope_path = abs_path
     search_scope_desc = posix_rel_path
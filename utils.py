@@ -46,6 +46,7 @@ import pathlib
 import platform
 import sys
 import re
+import socket
 
 from epc.client import EPCClient
 
@@ -65,6 +66,13 @@ def init_epc_client(emacs_server_port):
     if epc_client is None:
         try:
             epc_client = EPCClient(("127.0.0.1", emacs_server_port), log_traceback=True)
+            # Every eval_in_emacs (e.g. each streamed chunk) is a small write, don't let Nagle hold it back
+            sock = getattr(epc_client, "socket", None)
+            if sock is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except OSError:
+                    pass
         except ConnectionRefusedError:
             import traceback
             logger.error(traceback.format_exc())
@@ -131,8 +139,8 @@ def convert_emacs_bool(symbol_value, symbol_is_boolean):
         return symbol_value
 
 def get_emacs_vars(args):
-    return list(map(lambda result: convert_emacs_bool(result[0], result[1]) if result != [] else False,
-                    epc_client.call_sync("get-emacs-vars", args)))    # type: ignore
+    return [convert_emacs_bool(result[0], result[1]) if result != [] else False
+            for result in epc_client.call_sync("get-emacs-vars", args)]    # type: ignore
 
 
 def get_emacs_var(var_name):
@@ -240,6 +248,10 @@ def get_os_name():
 def parse_json_content(content):
     return json_parser.loads(content)
 
+def dump_json_content(content, sort_keys: bool = False) -> bytes:
+    """Serializes content to compact JSON bytes (raises TypeError if it can't)."""
+    return json_parser.dumps(content, option=json_parser.OPT_SORT_KEYS if sort_keys else None)
+
 def read_file_content(abs_path: str) -> str:
     """Reads the content of a file."""
     # Basic implementation, consider adding error handling for encoding etc.
@@ -275,9 +287,13 @@ def touch(path):
 
 
 # --- Filtering Helper ---
+# Use re.DOTALL to make '.' match newlines, make it non-greedy
+_ENVIRONMENT_DETAILS_RE = re.compile(r"<environment_details>.*?</environment_details>\s*", re.DOTALL)
+
 def _filter_environment_details(text: str) -> str:
     """Removes <environment_details>...</environment_details> blocks from text."""
     if not isinstance(text, str): # Handle potential non-string content
         return text
-    # Use re.DOTALL to make '.' match newlines, make it non-greedy
-    return re.sub(r"<environment_details>.*?</environment_details>\s*", "\n", text, flags=re.DOTALL)
+    if "<environment_details>" not in text: # Cheap check, most streamed chunks have no block
+        return text
+    return _ENVIRONMENT_DETAILS_RE.sub("\n", text)